@@ -0,0 +1 @@
+"""Скрипты для измерения производительности бота. Запускаются из корня проекта: python -m benchmarks.<имя>"""
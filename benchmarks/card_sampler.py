@@ -0,0 +1,41 @@
+"""Бенчмарк выбора случайных карточек из CardIndex.
+Показывает, что время выбора не зависит от количества карточек (от 1 тыс. до 1 млн).
+
+Запуск: python -m benchmarks.card_sampler
+"""
+import time
+
+from card_index import CardIndex
+
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+USERS = 1_000
+ITERATIONS = 100_000
+
+
+def build_index(size: int) -> CardIndex:
+    """Создает индекс, в котором половина карточек общие, а остальные распределены между пользователями."""
+    index = CardIndex()
+    for card_id in range(size):
+        user_id = None if card_id % 2 == 0 else card_id % USERS
+        index.add(card_id, f"слово {card_id}", f"word {card_id}", user_id)
+    return index
+
+
+def measure(index: CardIndex) -> float:
+    """Возвращает среднее время одного выбора 4 карточек в микросекундах."""
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        index.sample(i % USERS, 4)
+    return (time.perf_counter() - start) / ITERATIONS * 1_000_000
+
+
+def main():
+    print(f"{'cards':>10} | {'us/sample':>10}")
+    for size in SIZES:
+        index = build_index(size)
+        print(f"{size:>10} | {measure(index):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
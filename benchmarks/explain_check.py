@@ -0,0 +1,111 @@
+"""Проверка планов запросов к карточкам.
+
+Для запросов crud.py к таблицам cards, users_cards, card_distractors, deck_subscriptions и users выполняется EXPLAIN (FORMAT JSON) и проверяется,
+что в плане нет последовательного чтения (Seq Scan) этих таблиц и что используются ожидаемые индексы.
+В небольшой тестовой БД планировщик выбирает Seq Scan даже при наличии индекса, поэтому проверка выполняется
+с enable_seqscan = off. С этой настройкой планировщик выбирает любой индекс, даже если он не ограничивает
+чтение (например, полный обход первичного ключа с фильтром), поэтому отсутствия Seq Scan недостаточно:
+для каждого запроса перечислены индексы, которые должны быть в плане.
+Загрузка всего индекса карточек при запуске (load_card_index) читает таблицу целиком и не проверяется.
+
+Запуск: python -m benchmarks.explain_check
+Код завершения 1, если хотя бы один запрос читает таблицу последовательно или не использует ожидаемый индекс.
+"""
+import asyncio
+import json
+import sys
+
+from crud import (
+    IMPORT_CARDS_SQL, cards_page_query, decks_query, delete_cards_statement, distractors_query,
+    recipients_query, shared_card_exists_query, user_cards_query
+)
+from db_init import engine
+
+
+# Таблицы, которые не должны читаться последовательно
+CHECKED_TABLES = {"cards", "users_cards", "card_distractors", "deck_subscriptions", "users"}
+
+# Пользователь, для которого строятся планы. Данные не изменяются: EXPLAIN без ANALYZE не выполняет запрос
+USER_ID = 1
+
+
+def plan_nodes(plan: dict):
+    """Обходит все узлы плана."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+async def explain(driver_connection, sql: str, *params) -> list:
+    """Возвращает узлы плана запроса: (тип узла, таблица, индекс)."""
+    result = await driver_connection.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *params)
+    plan = (json.loads(result) if isinstance(result, str) else result)[0]["Plan"]
+    return [
+        (node["Node Type"], node.get("Relation Name"), node.get("Index Name"))
+        for node in plan_nodes(plan)
+    ]
+
+
+def missing_indexes(nodes: list, expected: list) -> list:
+    """Возвращает ожидаемые индексы, которых нет в плане. Элемент expected - имя индекса
+    или кортеж имен, если подходит любой из них."""
+    used = {index for _, _, index in nodes if index}
+    missing = []
+    for names in expected:
+        names = (names,) if isinstance(names, str) else names
+        if used.isdisjoint(names):
+            missing.append(" | ".join(names))
+    return missing
+
+
+def compile_query(query) -> tuple:
+    """Компилирует запрос SQLAlchemy в SQL asyncpg ($1, $2, ...) и список параметров."""
+    compiled = query.compile(dialect=engine.dialect)
+    return str(compiled), [compiled.params[name] for name in compiled.positiontup]
+
+
+async def main():
+    # Запрос: (SQL, параметры, индексы, которые должны быть в плане)
+    queries = {
+        "user_cards": (*compile_query(user_cards_query(USER_ID)), ["ix_cards_owner_id_id"]),
+        "cards_page_next": (*compile_query(cards_page_query(USER_ID, after_id=0)), ["ix_cards_owner_id_id"]),
+        "cards_page_prev": (*compile_query(cards_page_query(USER_ID, before_id=1000)), ["ix_cards_owner_id_id"]),
+        # Карточки находятся по списку ID: подходит и первичный ключ, и (owner_id, id)
+        "delete_cards": (*compile_query(delete_cards_statement(USER_ID, [1, 2, 3])), [("cards_pkey", "ix_cards_owner_id_id")]),
+        "shared_card_exists": (*compile_query(shared_card_exists_query()), ["ix_cards_shared"]),
+        "distractors": (*compile_query(distractors_query([1, 2, 3])), ["card_distractors_pkey"]),
+        "decks": (*compile_query(decks_query(USER_ID)), ["decks_pkey", "ix_cards_deck_id_id", "deck_subscriptions_pkey"]),
+        "broadcast_recipients": (*compile_query(recipients_query(USER_ID, 500)), ["users_pkey"]),
+        "import_cards": (IMPORT_CARDS_SQL, [USER_ID], ["ix_cards_owner_id_id", "ix_cards_shared"])
+    }
+
+    failed = False
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        async with driver_connection.transaction():
+            await driver_connection.execute("SET LOCAL enable_seqscan = off")
+            await driver_connection.execute(
+                "CREATE TEMP TABLE card_import (translate text NOT NULL, target_word text NOT NULL) ON COMMIT DROP"
+            )
+
+            for name, (sql, params, expected) in queries.items():
+                nodes = await explain(driver_connection, sql, *params)
+                seq_scans = [table for node_type, table, _ in nodes if node_type == "Seq Scan" and table in CHECKED_TABLES]
+                missing = missing_indexes(nodes, expected)
+                scans = ", ".join(
+                    f"{node_type} {table or ''}" + (f" ({index})" if index else "")
+                    for node_type, table, index in nodes if table or index
+                )
+
+                status = "FAIL" if seq_scans or missing else "ok"
+                failed = failed or status == "FAIL"
+                print(f"{status:4} {name}: {scans}" + (f"; missing indexes: {', '.join(missing)}" if missing else ""))
+
+    await engine.dispose()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
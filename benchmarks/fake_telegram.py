@@ -0,0 +1,173 @@
+"""Локальный имитатор Telegram для проверки пропускной способности бота в режиме webhook без сети.
+
+Скрипт поднимает фиктивный Bot API, на который бот отправляет ответы, и отправляет в webhook бота
+обновления от множества пользователей: /start, запуск теста и ответы на вопросы.
+Каждый пользователь отправляет следующее обновление только после того, как бот ответил на предыдущее.
+
+Перед запуском в settings.ini нужно указать:
+    [bot]
+    mode = webhook
+    api_server = http://127.0.0.1:8081
+
+Запуск: python main.py, затем в другом терминале python -m benchmarks.fake_telegram --users 100 --answers 20
+"""
+import argparse
+import asyncio
+import configparser
+import itertools
+import statistics
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+
+
+# Методы Bot API, которые возвращают отправленное сообщение
+MESSAGE_METHODS = {"sendmessage", "editmessagetext", "editmessagereplymarkup"}
+
+
+class FakeTelegram:
+    """Фиктивный Bot API. Считает ответы бота каждому пользователю."""
+
+    def __init__(self):
+        self.responses = defaultdict(int)
+        self._conditions = defaultdict(asyncio.Condition)
+        self._message_ids = itertools.count(1)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = await request.post()
+
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Card Bot", "username": "card_bot"}
+        elif method in MESSAGE_METHODS:
+            chat_id = int(data.get("chat_id", 0))
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", "")
+            }
+            await self._notify(chat_id)
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _notify(self, chat_id: int):
+        condition = self._conditions[chat_id]
+        async with condition:
+            self.responses[chat_id] += 1
+            condition.notify_all()
+
+    async def wait_responses(self, chat_id: int, count: int):
+        """Ожидает, пока бот отправит пользователю count сообщений."""
+        condition = self._conditions[chat_id]
+        async with condition:
+            await condition.wait_for(lambda: self.responses[chat_id] >= count)
+
+
+class UpdateFactory:
+    """Создает обновления Telegram с уникальными update_id."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id = next(self._ids)
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": user,
+                "text": text
+            }
+        }
+
+
+async def simulate_user(
+        user_id: int,
+        answers: int,
+        session: aiohttp.ClientSession,
+        webhook_url: str,
+        secret: str,
+        telegram: FakeTelegram,
+        updates: UpdateFactory,
+        latencies: list
+):
+    """Проходит сценарий одного пользователя и сохраняет время ответа бота на каждое обновление."""
+    # (текст сообщения, сколько сообщений бот отправит в ответ)
+    steps = [("/start", 1), ("📚 Запустить тест (случайные карточки) 📚", 1)] + [("answer", 2)] * answers
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    expected = 0
+
+    for text, responses in steps:
+        expected += responses
+        start = time.perf_counter()
+
+        async with session.post(webhook_url, json=updates.message(user_id, text), headers=headers) as response:
+            response.raise_for_status()
+
+        await telegram.wait_responses(user_id, expected)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(args):
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.api_host, args.api_port).start()
+
+    updates = UpdateFactory()
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=args.connections)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.wait_for(
+            asyncio.gather(*[
+                simulate_user(args.first_user_id + i, args.answers, session, args.webhook_url, args.secret,
+                              telegram, updates, latencies)
+                for i in range(args.users)
+            ]),
+            timeout=args.timeout
+        )
+        elapsed = time.perf_counter() - start
+
+    await runner.cleanup()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"updates: {len(latencies)}, time: {elapsed:.2f} s, updates/sec: {len(latencies) / elapsed:.1f}")
+    print(f"latency p50: {quantiles[49] * 1000:.1f} ms, p95: {quantiles[94] * 1000:.1f} ms, p99: {quantiles[98] * 1000:.1f} ms")
+
+
+def parse_args():
+    config = configparser.ConfigParser()
+    config.read("settings.ini")
+    webhook_port = config.getint("bot", "webhook_port", fallback=8080)
+    webhook_path = config.get("bot", "webhook_path", fallback="/webhook")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--answers", type=int, default=20, help="количество ответов каждого пользователя")
+    parser.add_argument("--first-user-id", type=int, default=1_000_000)
+    parser.add_argument("--webhook-url", default=f"http://127.0.0.1:{webhook_port}{webhook_path}")
+    parser.add_argument("--secret", default=config.get("bot", "webhook_secret", fallback=""))
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=600)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
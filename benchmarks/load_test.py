@@ -0,0 +1,383 @@
+"""Нагрузочный тест обработчиков бота без сети.
+
+Скрипт создает диспетчер из main.py с фиктивной сессией Bot API и передает ему обновления через dp.feed_update
+от множества одновременных пользователей. Каждый пользователь проходит сценарий: /start, тест
+(send_card/check_answer), добавление карточки, импорт карточек из файла, удаление карточки и просмотр статистики.
+Используется локальная БД из settings.ini. Данные тестовых пользователей удаляются до и после теста.
+
+Обновления сценария идут подряд без пауз, поэтому по умолчанию ограничение частоты обновлений (main.throttling)
+отключено, а фиктивная сессия не ограничивает отправку сообщений: иначе большинство обновлений отбрасывалось бы
+до обработчиков, и тест измерял бы только ограничение. С --limits используются лимиты из settings.ini
+(и планировщик отправки main.outbound); отброшенные и объединенные обновления выводятся отдельно.
+
+Результат (задержки p50/p95/p99 по обработчикам и функциям crud.py, обновления в секунду) записывается в JSON.
+Для сравнения с предыдущим запуском укажите его файл в --compare.
+
+Запуск: python -m benchmarks.load_test --users 1000 --answers 20 --output results.json
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
+from sqlalchemy import delete
+
+import crud
+import main
+from db_init import AsyncSessionLocal
+from metrics import THROTTLED_UPDATES
+from migrations import migrate
+from models import AnswerEvent, Card, FSMRecord, User
+
+
+# Методы Bot API, которые возвращают сообщение
+MESSAGE_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup"}
+
+# Файл, который "скачивается" при импорте карточек: IMPORT_ROWS строк CSV
+IMPORT_ROWS = 20
+IMPORT_FILE = "".join(f"импорт {i},import {i}\n" for i in range(IMPORT_ROWS)).encode("utf-8")
+
+
+class Timings:
+    """Задержки, собранные во время теста, по группам и именам."""
+
+    def __init__(self):
+        self.samples = defaultdict(lambda: defaultdict(list))
+
+    def add(self, group: str, name: str, seconds: float):
+        self.samples[group][name].append(seconds)
+
+    def report(self, group: str) -> dict:
+        result = {}
+        for name, samples in sorted(self.samples[group].items()):
+            quantiles = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+            result[name] = {
+                "count": len(samples),
+                "mean_ms": statistics.fmean(samples) * 1000,
+                "p50_ms": quantiles[49] * 1000,
+                "p95_ms": quantiles[94] * 1000,
+                "p99_ms": quantiles[98] * 1000
+            }
+        return result
+
+
+class MockSession(BaseSession):
+    """Сессия Bot API, которая не выполняет сетевых запросов.
+    Запоминает последнюю клавиатуру и последнее сообщение каждого чата, чтобы сценарий мог нажимать кнопки.
+    Любой скачиваемый файл содержит IMPORT_FILE."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = defaultdict(int)
+        self.reply_keyboards = {}
+        self.inline_messages = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int = None):
+        name = method.__api_method__
+        self.calls[name] += 1
+
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Card Bot", "username": "card_bot"}
+        elif name in MESSAGE_METHODS:
+            chat_id = int(method.chat_id)
+            message_id = getattr(method, "message_id", None) or next(self._message_ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": getattr(method, "text", None) or ""
+            }
+
+            markup = getattr(method, "reply_markup", None)
+            if isinstance(markup, ReplyKeyboardMarkup):
+                self.reply_keyboards[chat_id] = markup
+            elif isinstance(markup, InlineKeyboardMarkup):
+                self.inline_messages[chat_id] = (message_id, markup)
+        elif name == "getFile":
+            result = {"file_id": method.file_id, "file_unique_id": method.file_id, "file_size": len(IMPORT_FILE), "file_path": f"documents/{method.file_id}.csv"}
+        else:
+            result = True
+
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        for position in range(0, len(IMPORT_FILE), chunk_size):
+            yield IMPORT_FILE[position:position + chunk_size]
+
+    async def close(self):
+        pass
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Middleware, которое измеряет время работы каждого обработчика."""
+
+    def __init__(self, timings: Timings):
+        self.timings = timings
+
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.timings.add("handlers", data["handler"].callback.__name__, time.perf_counter() - start)
+
+
+def instrument_crud(timings: Timings):
+    """Заменяет асинхронные функции crud.py (в crud.py и main.py) обертками, которые измеряют время их работы."""
+    def timed(name, function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                timings.add("crud", name, time.perf_counter() - start)
+        return wrapper
+
+    for name, function in list(vars(crud).items()):
+        if inspect.iscoroutinefunction(function) and function.__module__ == crud.__name__:
+            wrapper = timed(name, function)
+            setattr(crud, name, wrapper)
+            if getattr(main, name, None) is function:
+                setattr(main, name, wrapper)
+
+    crud.stats_buffer._save = crud.save_answers
+    main.question_queue._loader = crud.get_random_cards
+
+
+class UpdateFactory:
+    """Создает обновления Telegram с уникальными update_id."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text
+            }
+        }
+
+    def document(self, user_id: int, file_name: str) -> dict:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "document": {"file_id": f"file{update_id}", "file_unique_id": f"file{update_id}", "file_name": file_name, "file_size": len(IMPORT_FILE)}
+            }
+        }
+
+    def callback(self, user_id: int, message_id: int, data: str) -> dict:
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": ""
+                }
+            }
+        }
+
+
+class LoadTest:
+    """Сценарии пользователей и подсчет результатов."""
+
+    def __init__(self, args, bot: Bot, session: MockSession, timings: Timings):
+        self.args = args
+        self.bot = bot
+        self.session = session
+        self.timings = timings
+        self.updates = UpdateFactory()
+        self.fed = 0
+
+    async def feed(self, update: dict):
+        start = time.perf_counter()
+        await main.dp.feed_update(self.bot, Update.model_validate(update, context={"bot": self.bot}))
+        self.timings.add("updates", "all", time.perf_counter() - start)
+        self.fed += 1
+
+    async def send(self, user_id: int, text: str):
+        await self.feed(self.updates.message(user_id, text))
+
+    async def press(self, user_id: int, predicate):
+        """Нажимает первую inline-кнопку последнего сообщения пользователя, для которой predicate(callback_data) истинно."""
+        message_id, markup = self.session.inline_messages[user_id]
+        for row in markup.inline_keyboard:
+            for button in row:
+                if button.callback_data and predicate(button.callback_data):
+                    await self.feed(self.updates.callback(user_id, message_id, button.callback_data))
+                    return
+
+    async def user_scenario(self, user_id: int):
+        await self.send(user_id, "/start")
+
+        await self.send(user_id, "📚 Запустить тест (случайные карточки) 📚")
+        for _ in range(self.args.answers):
+            keyboard = self.session.reply_keyboards.get(user_id)
+            words = [button.text for row in keyboard.keyboard[:2] for button in row] if keyboard else ["?"]
+            await self.send(user_id, random.choice(words))
+        await self.send(user_id, "🔚 Завершить")
+
+        await self.send(user_id, "➕ Добавить карточку 📝")
+        await self.send(user_id, f"слово {user_id}")
+        await self.send(user_id, f"word {user_id}")
+
+        await self.feed(self.updates.document(user_id, "cards.csv"))
+
+        await self.send(user_id, "❌ Удалить карточку 📝")
+        if user_id in self.session.inline_messages:
+            await self.press(user_id, lambda data: data.startswith("cards:toggle"))
+            await self.press(user_id, lambda data: data.startswith("cards:delete"))
+
+        await self.send(user_id, "📈 Статистика 📈")
+
+    async def run(self) -> dict:
+        user_ids = [self.args.first_user_id + i for i in range(self.args.users)]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                await self.user_scenario(user_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[limited(user_id) for user_id in user_ids])
+        elapsed = time.perf_counter() - start
+
+        return {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": vars(self.args),
+            "updates": self.fed,
+            "duration_s": elapsed,
+            "updates_per_sec": self.fed / elapsed,
+            "api_calls": dict(self.session.calls),
+            "update_latency": self.timings.report("updates"),
+            "handlers": self.timings.report("handlers"),
+            "crud": self.timings.report("crud")
+        }
+
+
+async def cleanup(first_user_id: int, users: int):
+    """Удаляет тестовых пользователей, их карточки, ответы и состояния FSM."""
+    last_user_id = first_user_id + users - 1
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(Card).where(Card.owner_id.between(first_user_id, last_user_id)))
+        await session.execute(delete(AnswerEvent).where(AnswerEvent.user_id.between(first_user_id, last_user_id)))
+        await session.execute(delete(FSMRecord).where(FSMRecord.user_id.between(first_user_id, last_user_id)))
+        await session.execute(delete(User).where(User.user_id.between(first_user_id, last_user_id)))
+        await session.commit()
+
+
+def throttled_counts() -> dict:
+    """Количество обновлений, отброшенных или объединенных ThrottlingMiddleware, по действиям."""
+    counts = defaultdict(int)
+    for metric in THROTTLED_UPDATES.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_total"):
+                counts[sample.labels["action"]] += int(sample.value)
+    return counts
+
+
+def compare(current: dict, previous: dict):
+    """Выводит изменение p95 по обработчикам и функциям crud.py относительно предыдущего запуска."""
+    print(f"updates/sec: {previous['updates_per_sec']:.1f} -> {current['updates_per_sec']:.1f}")
+    for group in ("handlers", "crud"):
+        for name, stats in current[group].items():
+            old = previous.get(group, {}).get(name)
+            if old:
+                change = (stats["p95_ms"] / old["p95_ms"] - 1) * 100 if old["p95_ms"] else 0
+                print(f"{group}.{name}: p95 {old['p95_ms']:.2f} -> {stats['p95_ms']:.2f} ms ({change:+.1f}%)")
+
+
+async def run(args):
+    logging.getLogger().setLevel(logging.WARNING)
+
+    timings = Timings()
+    session = MockSession()
+    bot = Bot(token=main.bot_token, session=session)
+    if args.limits:
+        session.middleware(main.outbound)
+    else:
+        main.throttling.limits = {}
+
+    instrument_crud(timings)
+    main.dp.message.middleware(HandlerTimingMiddleware(timings))
+    main.dp.callback_query.middleware(HandlerTimingMiddleware(timings))
+
+    await migrate()
+    await cleanup(args.first_user_id, args.users)
+    # Рассылки не запускаются: иначе тест создал бы сегодняшнее напоминание и отправил его через main.bot
+    await main.dp.emit_startup(bot=bot, dispatcher=main.dp, broadcasts_enabled=False)
+
+    throttled_before = throttled_counts()
+    try:
+        result = await LoadTest(args, bot, session, timings).run()
+        result["throttled"] = {
+            action: count - throttled_before.get(action, 0) for action, count in throttled_counts().items()
+        }
+    finally:
+        await crud.stats_buffer.flush()
+        await main.fsm_storage.flush()
+        await cleanup(args.first_user_id, args.users)
+        await main.dp.emit_shutdown(bot=bot, dispatcher=main.dp)
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(result, file, ensure_ascii=False, indent=2)
+
+    print(f"updates: {result['updates']}, time: {result['duration_s']:.2f} s, updates/sec: {result['updates_per_sec']:.1f}")
+    print(f"throttled updates: {dict(result['throttled']) or 0}")
+    for group in ("handlers", "crud"):
+        for name, stats in result[group].items():
+            print(f"{group}.{name}: n={stats['count']} p50={stats['p50_ms']:.2f} p95={stats['p95_ms']:.2f} p99={stats['p99_ms']:.2f} ms")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            compare(result, json.load(file))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--answers", type=int, default=20, help="количество ответов каждого пользователя")
+    parser.add_argument("--concurrency", type=int, default=1000, help="сколько пользователей работают одновременно")
+    parser.add_argument("--first-user-id", type=int, default=2_000_000_000)
+    parser.add_argument("--limits", action="store_true", help="ограничивать частоту обновлений и отправку сообщений, как в боте")
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
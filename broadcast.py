@@ -0,0 +1,169 @@
+"""Рассылки всем пользователям: ежедневные напоминания и объявления.
+
+Планировщик работает в процессе бота (в режиме webhook - только в процессе 0). Получатели читаются пачками
+по первичному ключу users, сообщения отправляются несколькими задачами с низким приоритетом (bulk_priority),
+поэтому лимиты Telegram соблюдает OutboundScheduler, а ответы пользователям не задерживаются.
+После каждой пачки прогресс сохраняется в таблице broadcasts: прерванная рассылка продолжается
+с последнего сохраненного получателя. Пользователи, заблокировавшие бота, отмечаются и больше не получают рассылки.
+
+Объявление (отправляется работающим ботом в течение poll_interval секунд): python broadcast.py "Текст объявления"
+"""
+import asyncio
+import logging
+from datetime import datetime, time, timedelta, timezone
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError
+
+from crud import claim_broadcast, create_broadcast, get_recipients, release_broadcast, save_broadcast_progress
+from metrics import BROADCAST_MESSAGES
+from rate_limiter import bulk_priority
+
+
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+def parse_time(value: str):
+    """Разбирает время ежедневной рассылки из settings.ini ("ЧЧ:ММ", UTC). Пустая строка - рассылка отключена."""
+    return time.fromisoformat(value.strip()) if value.strip() else None
+
+
+class BroadcastScheduler:
+    """Планировщик рассылок.
+
+    Каждые poll_interval секунд создает ежедневное напоминание (если наступило reminder_time, UTC)
+    и выполняет незавершенные рассылки. Рассылка захватывается на lease, захват продлевается после каждой пачки,
+    поэтому одну рассылку не выполняют несколько процессов, а рассылку остановленного процесса продолжит другой."""
+
+    def __init__(
+            self,
+            bot: Bot,
+            reminder_time: time = None,
+            reminder_text: str = "",
+            batch_size: int = 500,
+            concurrency: int = 8,
+            poll_interval: float = 60,
+            lease: timedelta = timedelta(minutes=5)
+    ):
+        self.bot = bot
+        self.reminder_time = reminder_time
+        self.reminder_text = reminder_text
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+    async def run(self):
+        """Основной цикл планировщика. Ошибки записываются в журнал, цикл продолжается."""
+        while True:
+            try:
+                await self.create_reminder()
+                while await self.process_next():
+                    pass
+            except Exception:
+                logging.exception("Broadcast scheduler failed")
+            await asyncio.sleep(self.poll_interval)
+
+    async def create_reminder(self):
+        """Создает сегодняшнее напоминание, если наступило reminder_time. Повторно не создается благодаря имени."""
+        if not self.reminder_time or not self.reminder_text:
+            return
+
+        now = datetime.now(timezone.utc)
+        if now.time() >= self.reminder_time:
+            broadcast_id = await create_broadcast(f"reminder:{now.date().isoformat()}", self.reminder_text)
+            if broadcast_id:
+                logging.info("Reminder broadcast created", extra={"broadcast_id": broadcast_id})
+
+    async def process_next(self) -> bool:
+        """Захватывает и выполняет одну незавершенную рассылку. Возвращает False, если таких рассылок нет."""
+        broadcast = await claim_broadcast(self.lease)
+        if broadcast is None:
+            return False
+
+        broadcast_id, text, last_user_id, token = broadcast
+        logging.info("Broadcast started", extra={"broadcast_id": broadcast_id, "last_user_id": last_user_id})
+        try:
+            await self.process(broadcast_id, token, text, last_user_id)
+        except asyncio.CancelledError:
+            await release_broadcast(broadcast_id, token)
+            raise
+        return True
+
+    async def process(self, broadcast_id: int, token: str, text: str, last_user_id: int):
+        """Отправляет рассылку пачками получателей начиная после last_user_id и сохраняет прогресс после каждой пачки.
+        Если захват рассылки потерян (прогресс не сохранен), отправка прекращается: рассылку продолжает другой процесс."""
+        total = {SENT: 0, FAILED: 0, BLOCKED: 0}
+
+        while True:
+            user_ids = await get_recipients(last_user_id, self.batch_size)
+            finished = len(user_ids) < self.batch_size
+            results = await self.send_batch(user_ids, text)
+
+            blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == BLOCKED]
+            sent = results.count(SENT)
+            failed = results.count(FAILED)
+            if user_ids:
+                last_user_id = user_ids[-1]
+            saved = await save_broadcast_progress(
+                broadcast_id, token, last_user_id, sent, failed, blocked_ids, self.lease, finished
+            )
+            if not saved:
+                logging.warning("Broadcast lease lost", extra={"broadcast_id": broadcast_id, "last_user_id": last_user_id})
+                return
+
+            total[SENT] += sent
+            total[FAILED] += failed
+            total[BLOCKED] += len(blocked_ids)
+            if finished:
+                break
+
+        logging.info("Broadcast finished", extra={"broadcast_id": broadcast_id, **total})
+
+    async def send_batch(self, user_ids: list, text: str) -> list:
+        """Отправляет сообщение пачке пользователей задачами-исполнителями (не больше concurrency одновременно).
+        Возвращает результат для каждого пользователя: SENT, FAILED или BLOCKED."""
+        results = [FAILED] * len(user_ids)
+        positions = iter(range(len(user_ids)))
+
+        async def worker():
+            for position in positions:
+                results[position] = await self.send(user_ids[position], text)
+
+        with bulk_priority():
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(user_ids)))))
+        return results
+
+    async def send(self, user_id: int, text: str) -> str:
+        """Отправляет сообщение одному пользователю. Ожидание лимитов и повторы после retry_after
+        выполняет OutboundScheduler."""
+        try:
+            await self.bot.send_message(user_id, text)
+            result = SENT
+        except TelegramForbiddenError:
+            result = BLOCKED
+        except Exception as error:
+            logging.warning("Broadcast message failed", extra={"user_id": user_id, "error": str(error)})
+            result = FAILED
+
+        BROADCAST_MESSAGES.labels(result=result).inc()
+        return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    from db_init import engine
+
+    async def main(text: str):
+        try:
+            name = f"announcement:{datetime.now(timezone.utc).isoformat()}"
+            print(f"Broadcast {await create_broadcast(name, text)} created")
+        finally:
+            await engine.dispose()
+
+    if len(sys.argv) != 2:
+        sys.exit('Usage: python broadcast.py "Announcement text"')
+    asyncio.run(main(sys.argv[1]))
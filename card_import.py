@@ -0,0 +1,96 @@
+import asyncio
+import csv
+import html
+import re
+
+
+# Расширения файлов, которые принимаются для импорта
+SUPPORTED_EXTENSIONS = (".csv", ".tsv", ".txt")
+
+# Разделители, которые определяются автоматически, если в файле нет заголовка #separator
+DELIMITERS = "\t;,"
+
+# Заголовок #separator в текстовом экспорте Anki
+ANKI_SEPARATORS = {"tab": "\t", "comma": ",", "semicolon": ";", "pipe": "|", "space": " "}
+
+# Максимальная длина слова. Более длинные строки пропускаются
+MAX_WORD_LENGTH = 200
+
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+class ImportStats:
+    """Счетчики импорта: прочитанные и пропущенные строки."""
+
+    def __init__(self):
+        self.rows = 0
+        self.skipped = 0
+
+
+def clean_word(value: str, strip_html: bool) -> str:
+    """Убирает из слова HTML-разметку (для экспорта Anki) и лишние пробелы."""
+    if strip_html:
+        value = html.unescape(TAG_RE.sub(" ", value))
+    return " ".join(value.split())
+
+
+def read_header(file) -> tuple:
+    """Читает заголовки экспорта Anki (строки, начинающиеся с #) и определяет разделитель.
+    Возвращает (разделитель, признак HTML-разметки). Файл остается на первой строке с данными."""
+    delimiter = None
+    strip_html = False
+
+    while True:
+        position = file.tell()
+        line = file.readline()
+        if not line.startswith("#"):
+            file.seek(position)
+            break
+
+        name, _, value = line[1:].strip().partition(":")
+        if name == "separator":
+            delimiter = ANKI_SEPARATORS.get(value.lower(), value[:1] or None)
+        elif name == "html":
+            strip_html = value.lower() == "true"
+
+    if delimiter is None:
+        position = file.tell()
+        sample = file.read(64 * 1024)
+        file.seek(position)
+        try:
+            delimiter = csv.Sniffer().sniff(sample, delimiters=DELIMITERS).delimiter
+        except csv.Error:
+            delimiter = "\t"
+
+    return delimiter, strip_html
+
+
+async def read_cards(path: str, stats: ImportStats, progress=None, progress_every: int = 10_000):
+    """Асинхронный генератор карточек (translate, target_word) из файла CSV/TSV или текстового экспорта Anki.
+    Первая колонка - слово на русском, вторая - перевод. Остальные колонки игнорируются.
+    Файл читается построчно, поэтому потребление памяти не зависит от его размера.
+    progress - необязательная корутина, которая вызывается с количеством прочитанных строк каждые progress_every строк."""
+    with open(path, encoding="utf-8-sig", errors="replace", newline="") as file:
+        delimiter, strip_html = read_header(file)
+
+        for row in csv.reader(file, delimiter=delimiter):
+            stats.rows += 1
+
+            if stats.rows % progress_every == 0:
+                if progress:
+                    await progress(stats.rows)
+                else:
+                    await asyncio.sleep(0)
+
+            if len(row) < 2:
+                stats.skipped += 1
+                continue
+
+            translate = clean_word(row[0], strip_html)
+            target_word = clean_word(row[1], strip_html)
+
+            if not translate or not target_word or max(len(translate), len(target_word)) > MAX_WORD_LENGTH:
+                stats.skipped += 1
+                continue
+
+            yield translate, target_word
@@ -0,0 +1,205 @@
+import random
+
+
+class IdList:
+    """Список ID с добавлением, удалением и выбором по позиции за O(1).
+    Удаление выполняется перестановкой последнего элемента на место удаляемого."""
+
+    def __init__(self):
+        self._ids = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, position: int) -> int:
+        return self._ids[position]
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._positions
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def add(self, item_id: int):
+        if item_id in self._positions:
+            return
+        self._positions[item_id] = len(self._ids)
+        self._ids.append(item_id)
+
+    def remove(self, item_id: int):
+        position = self._positions.pop(item_id, None)
+        if position is None:
+            return
+        last_id = self._ids.pop()
+        if last_id != item_id:
+            self._ids[position] = last_id
+            self._positions[last_id] = position
+
+
+class CardIndex:
+    """Индекс карточек в памяти процесса.
+    Хранит содержимое карточек, список общих карточек, списки личных карточек пользователей,
+    списки карточек колод и подписки пользователей на колоды.
+    Выбор случайных карточек не зависит от размера таблицы cards.
+    shared_version увеличивается при каждом изменении списка общих карточек."""
+
+    def __init__(self):
+        self.shared_version = 0
+        self.cards = {}
+        self._owners = {}
+        self._card_decks = {}
+        self._shared = IdList()
+        self._users = {}
+        self._decks = {}
+        self._subscriptions = {}
+
+    def __len__(self):
+        return len(self.cards)
+
+    def clear(self):
+        self.cards.clear()
+        self._owners.clear()
+        self._card_decks.clear()
+        self._shared = IdList()
+        self.shared_version += 1
+        self._users.clear()
+        self._decks.clear()
+        self._subscriptions.clear()
+
+    def replace(self, other: "CardIndex"):
+        """Заменяет содержимое индекса содержимым other. Используется, чтобы индекс не был пустым во время загрузки."""
+        self.cards = other.cards
+        self._owners = other._owners
+        self._card_decks = other._card_decks
+        self._shared = other._shared
+        self.shared_version += 1
+        self._users = other._users
+        self._decks = other._decks
+        self._subscriptions = other._subscriptions
+
+    def add(self, card_id: int, translate: str, target_word: str, user_id: int = None, deck_id: int = None):
+        """Добавляет карточку в индекс. Если user_id не указан, карточка считается общей.
+        Карточка колоды deck_id доступна владельцу и подписчикам колоды."""
+        self.cards[card_id] = (translate, target_word)
+        self._owners[card_id] = user_id
+
+        if user_id is None:
+            self._shared.add(card_id)
+            self.shared_version += 1
+        else:
+            self._users.setdefault(user_id, IdList()).add(card_id)
+
+        if deck_id is not None:
+            self.set_deck(card_id, deck_id)
+
+    def remove(self, card_id: int):
+        """Удаляет карточку из индекса."""
+        if card_id not in self.cards:
+            return
+
+        del self.cards[card_id]
+        user_id = self._owners.pop(card_id)
+        self.set_deck(card_id, None)
+
+        if user_id is None:
+            self._shared.remove(card_id)
+            self.shared_version += 1
+        else:
+            user_cards = self._users[user_id]
+            user_cards.remove(card_id)
+            if not user_cards:
+                del self._users[user_id]
+
+    def set_deck(self, card_id: int, deck_id):
+        """Переносит карточку в колоду deck_id (None - убирает из колоды)."""
+        old_deck_id = self._card_decks.pop(card_id, None)
+        if old_deck_id is not None:
+            deck_cards = self._decks[old_deck_id]
+            deck_cards.remove(card_id)
+            if not deck_cards:
+                del self._decks[old_deck_id]
+
+        if deck_id is not None and card_id in self.cards:
+            self._card_decks[card_id] = deck_id
+            self._decks.setdefault(deck_id, IdList()).add(card_id)
+
+    def subscribe(self, user_id: int, deck_id: int):
+        """Добавляет подписку пользователя на колоду."""
+        self._subscriptions.setdefault(user_id, set()).add(deck_id)
+
+    def unsubscribe(self, user_id: int, deck_id: int):
+        """Удаляет подписку пользователя на колоду."""
+        decks = self._subscriptions.get(user_id)
+        if decks is not None:
+            decks.discard(deck_id)
+            if not decks:
+                del self._subscriptions[user_id]
+
+    def _lists(self, user_id: int) -> list:
+        """Списки карточек, доступных пользователю: общие, личные и карточки колод, на которые он подписан.
+        Карточки собственных колод пользователя уже входят в его личные карточки."""
+        lists = [self._shared]
+        user_cards = self._users.get(user_id)
+        if user_cards:
+            lists.append(user_cards)
+        for deck_id in self._subscriptions.get(user_id, ()):
+            deck_cards = self._decks.get(deck_id)
+            if deck_cards and self._owners[deck_cards[0]] != user_id:
+                lists.append(deck_cards)
+        return lists
+
+    def count(self, user_id: int) -> int:
+        """Количество карточек, доступных пользователю (общие, личные и карточки колод)."""
+        return sum(len(card_ids) for card_ids in self._lists(user_id))
+
+    def owner(self, card_id: int):
+        """Владелец карточки или None для общей карточки."""
+        return self._owners.get(card_id)
+
+    def is_available(self, card_id: int, user_id: int) -> bool:
+        """Доступна ли карточка пользователю: общая, личная или из колоды, на которую он подписан."""
+        if card_id not in self.cards:
+            return False
+        return (
+            self._owners[card_id] in (None, user_id)
+            or self._card_decks.get(card_id) in self._subscriptions.get(user_id, ())
+        )
+
+    def shared_ids(self) -> list:
+        """ID общих карточек."""
+        return list(self._shared)
+
+    def personal_ids(self, user_id: int) -> list:
+        """ID личных карточек пользователя."""
+        return list(self._users.get(user_id, ()))
+
+    def private_ids(self, user_id: int) -> list:
+        """ID личных карточек пользователя и карточек колод, на которые он подписан (доступные карточки без общих)."""
+        return [card_id for card_ids in self._lists(user_id)[1:] for card_id in card_ids]
+
+    def available_ids(self, user_id: int) -> list:
+        """ID всех карточек, доступных пользователю: сначала общие, затем личные и карточки колод."""
+        return [card_id for card_ids in self._lists(user_id) for card_id in card_ids]
+
+    def owners(self) -> list:
+        """ID пользователей, у которых есть личные карточки."""
+        return list(self._users)
+
+    def sample(self, user_id: int, k: int):
+        """Возвращает k различных случайных ID карточек, доступных пользователю.
+        Если карточек меньше k, возвращает None."""
+        lists = self._lists(user_id)
+        total = sum(len(card_ids) for card_ids in lists)
+
+        if total < k:
+            return None
+
+        card_ids = []
+        for position in random.sample(range(total), k):
+            for list_ids in lists:
+                if position < len(list_ids):
+                    card_ids.append(list_ids[position])
+                    break
+                position -= len(list_ids)
+        return card_ids
@@ -1,12 +1,58 @@
-from db_init import AsyncSessionLocal
-from models import User, Card, UserCard, UserStats
+from db_init import AsyncSessionLocal, DATABASE_DSN, engine, read_router
+from models import User, Card, UserCard, UserStats, CardReview, AnswerEvent, UserDailyStats, CardStats, CardDistractor, Deck, DeckSubscription, Broadcast
+from card_index import CardIndex
+from stats_buffer import StatsBuffer
+from user_cache import KnownUsers
+from leaderboard import Leaderboard
+from metrics import CARD_LISTENER_CONNECTED
 
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import func
-from sqlalchemy import or_
+from sqlalchemy import or_, all_, any_, bindparam, case, delete, exists, literal, text, update, Float, Integer, Interval
+from sqlalchemy.dialects.postgresql import ARRAY
 
+import asyncio
+import asyncpg
+import json
+import logging
 import random
+import secrets
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+
+# Индекс карточек в памяти. Заполняется при запуске функцией load_card_index
+card_index = CardIndex()
+
+# Рейтинг пользователей. Обновляется при сохранении ответов и периодически сверяется с БД функцией load_leaderboard
+leaderboard = Leaderboard()
+
+# Фоновые задачи, на которые нужно хранить ссылки до их завершения
+background_tasks = set()
+
+# Количество вариантов ответа в вопросе теста (верный ответ и слова других карточек)
+ANSWER_OPTIONS = 4
+
+# Количество похожих слов (кандидатов в неверные варианты ответа), которые хранятся для каждой карточки
+DISTRACTORS = 8
+
+# Канал PostgreSQL для уведомлений об изменении карточек (для синхронизации индекса между процессами)
+CARD_CHANNEL = "card_changes"
+
+# Параметры интервального повторения (алгоритм SM-2)
+START_EASE = 2.5
+MIN_EASE = 1.3
+EASE_BONUS = 0.1
+EASE_PENALTY = 0.2
+RETRY_DELAY = timedelta(minutes=10)
+# Сколько ближайших карточек для повторения читает get_due_card, чтобы пропустить недоступные пользователю
+DUE_CANDIDATES = 5
+
+# Кэш зарегистрированных пользователей. Заполняется при запуске функцией load_known_users
+known_users = KnownUsers()
 
 
 async def get_session() -> AsyncSession:
@@ -15,131 +61,1126 @@ async def get_session() -> AsyncSession:
         yield session
 
 
+async def load_known_users():
+    """Функция для загрузки зарегистрированных пользователей в кэш known_users.
+    Загружается не больше пользователей, чем помещается в кэш."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(User.user_id, User.name, User.full_name)
+            .limit(known_users.max_size)
+        )
+
+        for user_id, name, full_name in result:
+            # Пользователь мог быть добавлен или изменен функцией add_user, пока выполнялся запрос
+            if known_users.get(user_id) is None:
+                known_users.put(user_id, name, full_name)
+
+
 async def add_user(user_id: int, name: str, full_name: str):
-    """Функция для добавления пользователя в модель User. Добавление происходит, если его ещё нет в БД."""
+    """Функция для добавления пользователя в модель User.
+    Если пользователь есть в кэше known_users с теми же данными, запрос к БД не выполняется.
+    Иначе выполняется один запрос INSERT ... ON CONFLICT, который обновляет name и full_name, если они изменились."""
+    if known_users.get(user_id) == (name, full_name):
+        return
+
+    statement = insert(User).values(user_id=user_id, name=name, full_name=full_name)
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={"name": statement.excluded.name, "full_name": statement.excluded.full_name},
+        where=or_(
+            User.name.is_distinct_from(statement.excluded.name),
+            User.full_name.is_distinct_from(statement.excluded.full_name)
+        )
+    )
+
     async with AsyncSessionLocal() as session:
-        check_user = await session.execute(select(User).filter(User.user_id == user_id))
-        user = check_user.scalar()
-        if not user:
-            user = User(user_id=user_id, name=name, full_name=full_name)
-            session.add(user)
-            await session.commit()
+        await session.execute(statement)
+        await session.commit()
+
+    known_users.put(user_id, name, full_name)
+
+
+async def load_card_index():
+    """Функция для загрузки всех карточек в индекс card_index.
+    Вызывается при запуске бота и после переподключения подписки на изменения карточек,
+    далее индекс обновляется в add_card, delete_cards и по уведомлениям CARD_CHANNEL."""
+    loaded = CardIndex()
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(select(Card.id, Card.translate, Card.target_word, Card.owner_id, Card.deck_id))
+        for card_id, translate, target_word, owner_id, deck_id in result:
+            loaded.add(card_id, translate, target_word, owner_id, deck_id)
+
+        result = await session.execute(select(DeckSubscription.user_id, DeckSubscription.deck_id))
+        for user_id, deck_id in result:
+            loaded.subscribe(user_id, deck_id)
+
+    # Индекс заменяется целиком после загрузки, поэтому при повторной загрузке он не бывает пустым
+    card_index.replace(loaded)
+
+
+async def notify_card_change(session: AsyncSession, op: str, user_id: int, **fields):
+    """Функция для отправки уведомления об изменении карточек пользователя в канал CARD_CHANNEL.
+    Уведомление доставляется другим процессам бота только после фиксации транзакции."""
+    payload = json.dumps({"op": op, "user_id": user_id, **fields}, ensure_ascii=False)
+    await session.execute(select(func.pg_notify(CARD_CHANNEL, payload)))
+
+
+class CardChangesListener:
+    """Подписка на канал CARD_CHANNEL отдельным соединением asyncpg.
+    Соединение проверяется каждые ping_interval секунд. После его потери подписка восстанавливается
+    с экспоненциальной задержкой от min_delay до max_delay секунд, и индекс card_index загружается заново,
+    так как уведомления, отправленные без подписки, потеряны. Состояние подписки доступно в метрике
+    bot_card_listener_connected."""
+
+    def __init__(self, handle, min_delay: float = 1.0, max_delay: float = 60.0, ping_interval: float = 30.0):
+        self._handle = handle
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ping_interval = ping_interval
+        self._connection = None
+        self._lost = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        await self._connect()
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _connect(self):
+        if self._connection is not None:
+            self._connection.terminate()
+        self._lost.clear()
+        connection = await asyncpg.connect(DATABASE_DSN)
+        connection.add_termination_listener(lambda _: self._lost.set())
+        await connection.add_listener(CARD_CHANNEL, self._handle)
+        self._connection = connection
+        CARD_LISTENER_CONNECTED.set(1)
+
+    async def _alive(self) -> bool:
+        """Ждет ping_interval секунд или потери соединения, затем проверяет соединение запросом."""
+        try:
+            await asyncio.wait_for(self._lost.wait(), self.ping_interval)
+            return False
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await asyncio.wait_for(self._connection.fetchval("SELECT 1"), self.ping_interval)
+            return True
+        except Exception:
+            return False
+
+    async def _supervise(self):
+        while True:
+            if await self._alive():
+                continue
+
+            CARD_LISTENER_CONNECTED.set(0)
+            logging.warning("Card changes listener connection was lost, reconnecting")
+            delay = self.min_delay
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self._connect()
+                    await load_card_index()
+                    break
+                except Exception as error:
+                    CARD_LISTENER_CONNECTED.set(0)
+                    logging.warning("Card changes listener reconnect failed", extra={"error": str(error), "delay": delay})
+                    delay = min(delay * 2, self.max_delay)
+            logging.info("Card changes listener reconnected, card index reloaded", extra={"cards": len(card_index)})
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._connection is not None:
+            await self._connection.close()
+        CARD_LISTENER_CONNECTED.set(0)
+
+
+async def listen_card_changes(on_change=None) -> CardChangesListener:
+    """Функция для подписки на изменения карточек, сделанные другими процессами бота.
+    Изменения применяются к индексу card_index, затем вызывается on_change(user_id) для владельца карточек
+    или пользователя, изменившего подписку на колоду.
+    Возвращает подписку, которую нужно закрыть методом close при остановке бота."""
+    def handle(connection, pid, channel, payload):
+        event = json.loads(payload)
+        user_id = event["user_id"]
+        read_router.mark_write(user_id)
+
+        # Карточки не передаются в уведомлении (размер pg_notify ограничен 8000 байт) и читаются из БД
+        if event["op"] in ("import", "share", "add"):
+            if event["op"] == "import":
+                load = load_user_cards(user_id)
+            elif event["op"] == "share":
+                load = load_deck_cards(event["deck_id"])
+            else:
+                load = load_card(event["id"])
+            task = asyncio.create_task(load)
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+            if on_change:
+                task.add_done_callback(lambda _: on_change(user_id))
+            return
+
+        if event["op"] == "delete":
+            for card_id in event["ids"]:
+                card_index.remove(card_id)
+        elif event["op"] == "subscribe":
+            card_index.subscribe(user_id, event["deck_id"])
+        elif event["op"] == "unsubscribe":
+            card_index.unsubscribe(user_id, event["deck_id"])
+
+        if on_change:
+            on_change(user_id)
+
+    listener = CardChangesListener(handle)
+    await listener.start()
+    return listener
+
+
+def distractors_query(card_ids: list):
+    """Запрос похожих карточек для списка карточек по первичному ключу card_distractors, от самых похожих."""
+    return (
+        select(CardDistractor.card_id, CardDistractor.distractor_id)
+        .where(CardDistractor.card_id == any_(bindparam("card_ids", list(card_ids), type_=ARRAY(Integer))))
+        .order_by(CardDistractor.card_id, CardDistractor.similarity.desc())
+    )
+
+
+async def load_distractors(card_ids: list) -> dict:
+    """Функция для загрузки похожих карточек одним запросом. Возвращает словарь card_id -> [distractor_id, ...]."""
+    if not card_ids:
+        return {}
+
+    async with read_router.session() as session:
+        result = await session.execute(distractors_query(card_ids))
+
+    distractors = defaultdict(list)
+    for card_id, distractor_id in result:
+        distractors[card_id].append(distractor_id)
+    return distractors
+
+
+def choose_answer_words(user_id: int, target_id: int, distractor_ids: list, fallback_ids: list) -> list:
+    """Выбирает ANSWER_OPTIONS - 1 неверных вариантов ответа.
+    Сначала берутся случайные из похожих карточек, доступных пользователю, затем слова случайных карточек fallback_ids.
+    Слова, совпадающие с верным ответом, и повторы пропускаются, пока хватает случайных карточек."""
+    target_word = card_index.cards[target_id][1]
+    available = [card_id for card_id in distractor_ids if card_index.is_available(card_id, user_id)]
+    chosen = random.sample(available, min(len(available), ANSWER_OPTIONS - 1))
+    candidates = [card_id for card_id in chosen + fallback_ids if card_id != target_id and card_id in card_index.cards]
+
+    answer_words = []
+    for card_id in candidates:
+        word = card_index.cards[card_id][1]
+        if word != target_word and word not in answer_words:
+            answer_words.append(word)
+
+    # Если различных слов не хватило, варианты могут повторяться: количество вариантов в вопросе постоянно
+    for card_id in candidates:
+        if len(answer_words) >= ANSWER_OPTIONS - 1:
+            break
+        answer_words.append(card_index.cards[card_id][1])
+
+    return answer_words[:ANSWER_OPTIONS - 1]
 
 
 async def get_random_card(user_id):
-    """Функция для получения случайной карточки и вариантов ответов.
-    Для получения случайной карточки должно быть минимум 4 карточки в БД общих и пользователя.
+    """Функция для получения случайной карточки и вариантов ответов.
+    Для получения случайной карточки должно быть минимум ANSWER_OPTIONS карточек в БД общих и пользователя.
     """
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Card)
-            .join(UserCard, isouter=True)
-            .filter(or_(UserCard.user_id == None, UserCard.user_id == user_id))
-            .order_by(func.random())
-            .limit(4)
-        )
-        cards = result.scalars().all()
+    questions = await get_random_cards(user_id, 1)
+    return questions[0] if questions else None
 
-        if len(cards) < 4:
-            return None
 
-        target_card = random.choice(cards)
-        cards.remove(target_card)
+async def get_random_cards(user_id: int, count: int):
+    """Функция для получения нескольких случайных карточек с вариантами ответов за один вызов.
+    Карточки выбираются из индекса card_index, неверные варианты - из похожих карточек (card_distractors),
+    которые загружаются одним запросом для всех карточек. Используется для пополнения очереди вопросов.
+    Если карточек недостаточно, возвращает пустой список."""
+    samples = []
+    for _ in range(count):
+        card_ids = card_index.sample(user_id, ANSWER_OPTIONS)
+        if card_ids is None:
+            break
+        samples.append(card_ids)
 
-        random_answers = random.sample(cards, 3)
+    distractors = await load_distractors([card_ids[-1] for card_ids in samples])
 
-        answer_words = [word.target_word for word in random_answers]
+    questions = []
+    for card_ids in samples:
+        target_id = card_ids.pop()
+        # Карточка могла быть удалена, пока загружались похожие карточки
+        if target_id not in card_index.cards:
+            continue
+        translate, target_word = card_index.cards[target_id]
+        answer_words = choose_answer_words(user_id, target_id, distractors.get(target_id, []), card_ids)
+        questions.append((target_id, translate, target_word, answer_words))
 
-        return target_card.id, target_card.translate, target_card.target_word, answer_words
+    return questions
 
 
 async def add_card(user_id: int, translate: str, target_word: str):
-    """Функция для добавления карточки в модель Card.
-    Также добавляется связь между пользователем и карточкой в модели UserCard."""
+    """Функция для добавления карточки пользователя в модель Card.
+    Также добавляется связь между пользователем и карточкой в модели UserCard.
+    Карточка, связь и уведомление сохраняются в одной транзакции.
+    Похожие карточки для новой карточки вычисляются в фоновой задаче."""
     async with AsyncSessionLocal() as session:
-        card = Card(translate=translate, target_word=target_word)
+        card = Card(translate=translate, target_word=target_word, owner_id=user_id)
         session.add(card)
+        await session.flush()
+
+        session.add(UserCard(user_id=user_id, card_id=card.id))
+        await notify_card_change(session, "add", user_id, id=card.id)
         await session.commit()
 
-        user_card = UserCard(user_id=user_id, card_id=card.id)
-        session.add(user_card)
+    read_router.mark_write(user_id)
+    card_index.add(card.id, translate, target_word, user_id)
+
+    task = asyncio.create_task(update_distractors(card.id, user_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def distractor_rows(card_ids: list, pool_ids: list, positions, similarity) -> list:
+    """Преобразует результат most_similar в строки card_distractors (card_id, distractor_id, similarity)."""
+    return [
+        (card_id, pool_ids[position], float(score))
+        for card_id, card_positions, card_similarity in zip(card_ids, positions, similarity)
+        for position, score in zip(card_positions, card_similarity)
+        if position >= 0
+    ]
+
+
+class SharedWords:
+    """Разреженные векторы слов общих карточек (distractors.WordVectors) для update_distractors.
+    Создаются при первом добавлении карточки. При изменении card_index.shared_version векторизуются только
+    добавленные общие карточки, а удаленные исключаются. Обновление и поиск выполняются в отдельном потоке
+    под блокировкой, поэтому векторы не изменяются во время поиска."""
+
+    def __init__(self):
+        self.version = None
+        self.vectors = None
+        self.lock = asyncio.Lock()
+
+    async def similar_rows(self, card_ids: list, target_words: list, k: int) -> list:
+        """Возвращает строки card_distractors (card_id, distractor_id, similarity): для каждой карточки card_ids
+        со словом из target_words - k самых похожих общих карточек."""
+        from distractors import WordVectors
+
+        async with self.lock:
+            if self.vectors is None:
+                self.vectors = WordVectors()
+
+            version = card_index.shared_version
+            added_ids = removed_ids = ()
+            if self.version != version:
+                shared_ids = card_index.shared_ids()
+                added_ids = [card_id for card_id in shared_ids if card_id not in self.vectors]
+                removed_ids = set(self.vectors.ids) - set(shared_ids)
+            added_words = [card_index.cards[card_id][1] for card_id in added_ids]
+
+            def search():
+                self.vectors.remove(removed_ids)
+                self.vectors.add(added_ids, added_words)
+                return self.vectors.most_similar(target_words, k)
+
+            positions, similarity = await asyncio.to_thread(search)
+            self.version = version
+            return distractor_rows(card_ids, self.vectors.ids, positions, similarity)
+
+
+shared_words = SharedWords()
+
+
+async def update_distractors(card_id: int, user_id: int):
+    """Функция для обновления похожих карточек после добавления карточки пользователя.
+    Для новой карточки сохраняются DISTRACTORS самых похожих из общих карточек и карточек пользователя.
+    Векторы общих карточек берутся из shared_words, векторизуются только новое слово и карточки пользователя.
+    Новая карточка добавляется в похожие только для личных карточек того же пользователя
+    (список каждой из них сокращается до DISTRACTORS): общие карточки видят все пользователи,
+    и личная карточка не должна попадать в их варианты ответа."""
+    if card_id not in card_index.cards:
+        return
+
+    from distractors import most_similar
+
+    target_words = [card_index.cards[card_id][1]]
+    private_ids = [pool_id for pool_id in card_index.private_ids(user_id) if pool_id != card_id]
+    private_words = [card_index.cards[pool_id][1] for pool_id in private_ids]
+
+    rows = await shared_words.similar_rows([card_id], target_words, DISTRACTORS)
+    positions, similarity = await asyncio.to_thread(most_similar, target_words, private_words, DISTRACTORS)
+    rows += distractor_rows([card_id], private_ids, positions, similarity)
+    rows = sorted(rows, key=lambda row: row[2], reverse=True)[:DISTRACTORS]
+    neighbour_ids = [distractor_id for _, distractor_id, _ in rows if card_index.owner(distractor_id) == user_id]
+    rows += [(neighbour_id, card_id, score) for _, neighbour_id, score in rows if neighbour_id in neighbour_ids]
+    if not rows:
+        return
+
+    statement = insert(CardDistractor).values([
+        {"card_id": row_card_id, "distractor_id": distractor_id, "similarity": score}
+        for row_card_id, distractor_id, score in rows
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[CardDistractor.card_id, CardDistractor.distractor_id],
+        set_={"similarity": statement.excluded.similarity}
+    )
+
+    ranked = (
+        select(
+            CardDistractor.card_id,
+            CardDistractor.distractor_id,
+            func.row_number().over(
+                partition_by=CardDistractor.card_id, order_by=CardDistractor.similarity.desc()
+            ).label("position")
+        )
+        .where(CardDistractor.card_id == any_(bindparam("card_ids", neighbour_ids, type_=ARRAY(Integer))))
+        .subquery()
+    )
+
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(statement)
+            if neighbour_ids:
+                await session.execute(
+                    delete(CardDistractor)
+                    .where(
+                        CardDistractor.card_id == ranked.c.card_id,
+                        CardDistractor.distractor_id == ranked.c.distractor_id,
+                        ranked.c.position > DISTRACTORS
+                    )
+                )
+            await session.commit()
+    except Exception:
+        # Карточка или похожая карточка могла быть удалена; похожие карточки пересчитываются командой python distractors.py
+        logging.exception("Failed to update distractors", extra={"user_id": user_id, "card_id": card_id})
+
+
+async def rebuild_distractors() -> int:
+    """Функция для полного пересчета таблицы card_distractors по всем карточкам.
+    Общие карточки сравниваются с общими, личные карточки пользователя - с общими и своими.
+    Таблица перезаписывается в одной транзакции командой COPY. Возвращает количество карточек с похожими карточками."""
+    from distractors import most_similar
+
+    await load_card_index()
+
+    groups = [(card_index.shared_ids(), card_index.shared_ids())]
+    groups += [(card_index.personal_ids(owner_id), card_index.available_ids(owner_id)) for owner_id in card_index.owners()]
+
+    rows = []
+    for card_ids, pool_ids in groups:
+        positions, similarity = await asyncio.to_thread(
+            most_similar,
+            [card_index.cards[card_id][1] for card_id in card_ids],
+            [card_index.cards[pool_id][1] for pool_id in pool_ids],
+            DISTRACTORS
+        )
+        rows += distractor_rows(card_ids, pool_ids, positions, similarity)
+
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        async with driver_connection.transaction():
+            await driver_connection.execute("TRUNCATE card_distractors")
+            await driver_connection.copy_records_to_table(
+                "card_distractors", records=rows, columns=["card_id", "distractor_id", "similarity"]
+            )
+
+    return len({card_id for card_id, _, _ in rows})
+
+
+def user_cards_query(user_id: int):
+    """Запрос карточек пользователя. Выполняется только по индексу ix_cards_owner_id_id."""
+    return select(Card.id, Card.translate, Card.target_word).filter(Card.owner_id == user_id)
+
+
+def cards_page_query(user_id: int, after_id: int = 0, before_id: int = None, limit: int = 10):
+    """Запрос страницы карточек пользователя для get_cards_page (limit + 1 строк, чтобы узнать, есть ли еще карточки)."""
+    query = user_cards_query(user_id)
+
+    if before_id is not None:
+        query = query.filter(Card.id < before_id).order_by(Card.id.desc())
+    else:
+        query = query.filter(Card.id > after_id).order_by(Card.id)
+
+    return query.limit(limit + 1)
+
+
+async def get_cards_page(user_id: int, after_id: int = 0, before_id: int = None, limit: int = 10):
+    """Функция для получения страницы карточек пользователя (keyset-пагинация по индексу cards (owner_id, id)).
+    Если указан before_id, возвращается страница перед карточкой before_id, иначе страница после карточки after_id.
+    Возвращает (карточки, есть ли еще карточки в направлении запроса). Карточки отсортированы по возрастанию ID."""
+    async with read_router.session(user_id) as session:
+        result = await session.execute(cards_page_query(user_id, after_id, before_id, limit))
+        cards = result.all()
+
+    has_more = len(cards) > limit
+    cards = cards[:limit]
+
+    if before_id is not None:
+        cards.reverse()
+
+    return cards, has_more
+
+
+def delete_cards_statement(user_id: int, card_ids: list):
+    """Запрос удаления карточек пользователя для delete_cards. Карточки находятся по первичному ключу."""
+    return (
+        delete(Card)
+        .where(Card.id == any_(bindparam("card_ids", card_ids, type_=ARRAY(Integer))), Card.owner_id == user_id)
+        .returning(Card.id)
+    )
+
+
+async def delete_cards(user_id: int, card_ids: list) -> list:
+    """Функция для удаления карточек пользователя одним запросом DELETE ... WHERE id = ANY(...) RETURNING.
+    Удаляются только карточки, которые принадлежат пользователю. Возвращает ID удаленных карточек."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete_cards_statement(user_id, card_ids))
+        deleted_ids = list(result.scalars())
+
+        if deleted_ids:
+            await session.execute(
+                delete(CardStats).where(CardStats.user_id == user_id, CardStats.card_id.in_(deleted_ids))
+            )
+            await notify_card_change(session, "delete", user_id, ids=deleted_ids)
         await session.commit()
 
+    read_router.mark_write(user_id)
+    for card_id in deleted_ids:
+        card_index.remove(card_id)
+
+    return deleted_ids
+
+
+# Перенос карточек из временной таблицы card_import в cards и users_cards.
+# Пропускаются повторы внутри файла и карточки, которые уже есть у пользователя или среди общих карточек.
+# Карточки пользователя и общие карточки проверяются по индексам ix_cards_owner_id_id и ix_cards_shared.
+IMPORT_CARDS_SQL = """
+WITH new_cards AS (
+    INSERT INTO cards (translate, target_word, owner_id)
+    SELECT DISTINCT i.translate, i.target_word, $1::integer
+    FROM card_import i
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM cards c
+        WHERE c.owner_id = $1
+          AND c.translate = i.translate
+          AND c.target_word = i.target_word
+    )
+      AND NOT EXISTS (
+        SELECT 1
+        FROM cards c
+        WHERE c.owner_id IS NULL
+          AND c.translate = i.translate
+          AND c.target_word = i.target_word
+    )
+    RETURNING id, translate, target_word
+), new_users_cards AS (
+    INSERT INTO users_cards (user_id, card_id)
+    SELECT $1, id FROM new_cards
+)
+SELECT id, translate, target_word FROM new_cards
+"""
 
-async def get_cards(user_id: int):
-    """Функция для получения всех карточек пользователя."""
+
+async def import_cards(user_id: int, records) -> int:
+    """Функция для массового добавления карточек пользователя.
+    records - асинхронный итератор пар (translate, target_word). Записи загружаются командой COPY во временную таблицу,
+    затем одним запросом INSERT ... SELECT переносятся в cards и users_cards. Все выполняется в одной транзакции.
+    Возвращает количество добавленных карточек."""
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        async with driver_connection.transaction():
+            await driver_connection.execute(
+                "CREATE TEMP TABLE card_import (translate text NOT NULL, target_word text NOT NULL) ON COMMIT DROP"
+            )
+            await driver_connection.copy_records_to_table(
+                "card_import", records=records, columns=["translate", "target_word"]
+            )
+            rows = await driver_connection.fetch(IMPORT_CARDS_SQL, user_id)
+            await driver_connection.execute(
+                "SELECT pg_notify($1, $2)", CARD_CHANNEL, json.dumps({"op": "import", "user_id": user_id})
+            )
+
+    read_router.mark_write(user_id)
+    for card_id, translate, target_word in rows:
+        card_index.add(card_id, translate, target_word, user_id)
+
+    return len(rows)
+
+
+async def load_user_cards(user_id: int):
+    """Функция для загрузки всех карточек пользователя в индекс card_index."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(user_cards_query(user_id))
+
+        for card_id, translate, target_word in result:
+            card_index.add(card_id, translate, target_word, user_id)
+
+
+async def load_card(card_id: int):
+    """Функция для загрузки одной карточки в индекс card_index по первичному ключу (если она еще не удалена)."""
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(Card)
-            .join(UserCard)
-            .filter(UserCard.user_id == user_id))
-        cards = result.scalars().all()
-        return cards
+            select(Card.translate, Card.target_word, Card.owner_id, Card.deck_id).where(Card.id == card_id)
+        )
+        row = result.first()
+
+    if row is not None:
+        card_index.add(card_id, *row)
 
 
-async def delete_card_db(card_id: int):
-    """Функция для удаления карточки из модели Card."""
+async def load_deck_cards(deck_id: int):
+    """Функция для переноса карточек колоды в колоду в индексе card_index (по индексу ix_cards_deck_id_id)."""
     async with AsyncSessionLocal() as session:
+        result = await session.execute(select(Card.id).where(Card.deck_id == deck_id))
+
+        for card_id in result.scalars():
+            card_index.set_deck(card_id, deck_id)
+
+
+def review_values(repetitions, interval, ease, correct: bool) -> dict:
+    """Функция для расчета нового состояния повторения карточки по алгоритму SM-2.
+    Аргументы - SQL-выражения текущего состояния, результат - SQL-выражения для колонок CardReview."""
+    if correct:
+        new_interval = case((repetitions == 0, 1.0), (repetitions == 1, 6.0), else_=interval * ease)
+        return {
+            "repetitions": repetitions + 1,
+            "interval": new_interval,
+            "ease": ease + EASE_BONUS,
+            "next_due": func.now() + new_interval * literal(timedelta(days=1), Interval)
+        }
+
+    return {
+        "repetitions": 0,
+        "interval": 0.0,
+        "ease": func.greatest(MIN_EASE, ease - EASE_PENALTY),
+        "next_due": func.now() + literal(RETRY_DELAY, Interval)
+    }
+
+
+def review_statements(events: list) -> list:
+    """Функция для создания запросов INSERT ... ON CONFLICT, которые обновляют состояние повторения карточек по ответам.
+    Для новой карточки состояние считается от начальных значений, для существующей - от сохраненных.
+    Один запрос не может изменить строку дважды, поэтому повторные ответы на ту же карточку попадают в следующий
+    круг запросов; в каждом круге правильные и неправильные ответы обновляются отдельными запросами.
+    Ответы на карточки, которых уже нет в индексе (удалены), пропускаются."""
+    rounds = []
+    answers = defaultdict(int)
+    for user_id, card_id, correct, _ in events:
+        if card_id not in card_index.cards:
+            continue
+        number = answers[user_id, card_id]
+        answers[user_id, card_id] += 1
+        if number == len(rounds):
+            rounds.append({True: [], False: []})
+        rounds[number][correct].append((user_id, card_id))
+
+    statements = []
+    for round_answers in rounds:
+        for correct, keys in round_answers.items():
+            if not keys:
+                continue
+            initial = review_values(literal(0, Integer), literal(0.0, Float), literal(START_EASE, Float), correct)
+            statement = insert(CardReview).values([
+                {"user_id": user_id, "card_id": card_id, **initial} for user_id, card_id in keys
+            ])
+            statements.append(statement.on_conflict_do_update(
+                index_elements=[CardReview.user_id, CardReview.card_id],
+                set_=review_values(CardReview.repetitions, CardReview.interval, CardReview.ease, correct)
+            ))
+    return statements
+
+
+async def get_due_card(user_id: int, exclude_ids=()):
+    """Функция для получения карточки, которую пора повторить, и вариантов ответов.
+    Карточка выбирается по индексу (user_id, next_due) вместе с похожими карточками (в том же запросе),
+    варианты ответов - из похожих карточек и индекса card_index.
+    Пропускаются карточки exclude_ids (пропущенные пользователем), карточки, ответы на которые еще в stats_buffer
+    (их состояние повторения в БД пока не обновлено), и карточки, которые больше не доступны пользователю.
+    Возвращает None, если карточек для повторения нет."""
+    exclude_ids = list(set(exclude_ids) | stats_buffer.pending_cards(user_id))
+    distractor_ids = (
+        select(CardDistractor.distractor_id)
+        .where(CardDistractor.card_id == CardReview.card_id)
+        .order_by(CardDistractor.similarity.desc())
+        .scalar_subquery()
+    )
+    async with read_router.session(user_id) as session:
         result = await session.execute(
-            select(Card)
-            .filter(Card.id == card_id))
-        card = result.scalars().first()
+            select(CardReview.card_id, func.array(distractor_ids))
+            .filter(
+                CardReview.user_id == user_id,
+                CardReview.next_due <= func.now(),
+                CardReview.card_id != all_(bindparam("exclude_ids", exclude_ids, type_=ARRAY(Integer)))
+            )
+            .order_by(CardReview.next_due)
+            .limit(DUE_CANDIDATES)
+        )
+        rows = result.all()
+
+    row = next((row for row in rows if card_index.is_available(row[0], user_id)), None)
+    if row is None:
+        return None
+    target_id, distractor_ids = row
 
-        await session.delete(card)
+    card_ids = card_index.sample(user_id, ANSWER_OPTIONS)
+    if card_ids is None:
+        return None
+
+    translate, target_word = card_index.cards[target_id]
+    answer_words = choose_answer_words(user_id, target_id, distractor_ids or [], card_ids)
+
+    return target_id, translate, target_word, answer_words
+
+
+def increment_counts(model, index_elements: list, rows: list):
+    """Функция для создания запроса INSERT ... ON CONFLICT, который прибавляет correct_answers и incorrect_answers
+    из rows к существующим значениям."""
+    statement = insert(model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={
+            "correct_answers": model.correct_answers + statement.excluded.correct_answers,
+            "incorrect_answers": model.incorrect_answers + statement.excluded.incorrect_answers
+        }
+    )
+
+
+async def save_answers(events: list):
+    """Функция для сохранения накопленных ответов пользователей.
+    events - список (user_id, card_id, correct, answered_at). В одной транзакции ответы добавляются в журнал answer_events,
+    сводные таблицы user_stats, user_daily_stats и card_stats обновляются одним запросом каждая,
+    а состояния повторения card_reviews - запросами из review_statements."""
+    users = defaultdict(lambda: [0, 0])
+    days = defaultdict(lambda: [0, 0])
+    cards = defaultdict(lambda: [0, 0])
+
+    for user_id, card_id, correct, answered_at in events:
+        position = 0 if correct else 1
+        users[user_id][position] += 1
+        days[user_id, answered_at.date()][position] += 1
+        cards[user_id, card_id][position] += 1
+
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            AnswerEvent.__table__.insert(),
+            [
+                {"user_id": user_id, "card_id": card_id, "correct": correct, "answered_at": answered_at}
+                for user_id, card_id, correct, answered_at in events
+            ]
+        )
+        await session.execute(increment_counts(UserStats, [UserStats.user_id], [
+            {"user_id": user_id, "correct_answers": correct, "incorrect_answers": incorrect}
+            for user_id, (correct, incorrect) in users.items()
+        ]))
+        await session.execute(increment_counts(UserDailyStats, [UserDailyStats.user_id, UserDailyStats.day], [
+            {"user_id": user_id, "day": day, "correct_answers": correct, "incorrect_answers": incorrect}
+            for (user_id, day), (correct, incorrect) in days.items()
+        ]))
+        await session.execute(increment_counts(CardStats, [CardStats.user_id, CardStats.card_id], [
+            {"user_id": user_id, "card_id": card_id, "correct_answers": correct, "incorrect_answers": incorrect}
+            for (user_id, card_id), (correct, incorrect) in cards.items()
+        ]))
+        for statement in review_statements(events):
+            await session.execute(statement)
         await session.commit()
 
+    for user_id, (correct, incorrect) in users.items():
+        read_router.mark_write(user_id)
+        leaderboard.add(user_id, correct, incorrect)
+
+
+# Буфер ответов пользователей. Сохраняется в БД функцией save_answers
+stats_buffer = StatsBuffer(save_answers, permanent_errors=(IntegrityError, DataError))
+
+
+async def update_stats(user_id: int, card_id: int, correct: bool):
+    """Функция для обновления статистики и состояния повторения карточки пользователя.
+    Ответ добавляется в буфер stats_buffer, который периодически сохраняется в БД одной транзакцией."""
+    stats_buffer.add(user_id, card_id, correct)
+
+
+async def get_user_stats(user_id: int):
+    """Функция для получения статистики пользователя.
+    К сохраненной статистике добавляются еще не сохраненные ответы из stats_buffer."""
+    async def read():
+        async with read_router.session(user_id) as session:
+            result = await session.execute(
+                select(
+                    func.sum(UserStats.correct_answers),
+                    func.sum(UserStats.incorrect_answers)
+                )
+                .filter(UserStats.user_id == user_id)
+            )
+            return result.fetchone()
+
+    (correct, incorrect), (pending_correct, pending_incorrect) = await stats_buffer.read_consistent(user_id, read)
+
+    return (correct or 0) + pending_correct, (incorrect or 0) + pending_incorrect
+
+
+async def get_daily_stats(user_id: int, days: int = 7):
+    """Функция для получения статистики пользователя по дням за последние days дней из сводной таблицы user_daily_stats.
+    Возвращает список (день, правильные, неправильные), отсортированный по дате."""
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+
+    async with read_router.session(user_id) as session:
+        result = await session.execute(
+            select(UserDailyStats.day, UserDailyStats.correct_answers, UserDailyStats.incorrect_answers)
+            .filter(UserDailyStats.user_id == user_id, UserDailyStats.day >= since)
+            .order_by(UserDailyStats.day)
+        )
+        return result.all()
+
+
+async def get_hardest_cards(user_id: int, limit: int = 5):
+    """Функция для получения карточек, в которых пользователь чаще всего ошибается, из сводной таблицы card_stats.
+    Возвращает список (translate, target_word, правильные, неправильные)."""
+    async with read_router.session(user_id) as session:
+        result = await session.execute(
+            select(Card.translate, Card.target_word, CardStats.correct_answers, CardStats.incorrect_answers)
+            .join(Card, Card.id == CardStats.card_id)
+            .filter(CardStats.user_id == user_id, CardStats.incorrect_answers > 0)
+            .order_by(
+                (CardStats.incorrect_answers * 1.0 / (CardStats.correct_answers + CardStats.incorrect_answers)).desc(),
+                CardStats.incorrect_answers.desc()
+            )
+            .limit(limit)
+        )
+        return result.all()
+
+
+async def load_leaderboard():
+    """Функция для загрузки рейтинга пользователей из user_stats.
+    Выполняется под блокировкой stats_buffer, чтобы сохранение ответов не пересекалось с загрузкой."""
+    async with stats_buffer.lock, AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(
+                UserStats.user_id,
+                UserStats.correct_answers,
+                UserStats.incorrect_answers,
+                func.coalesce(User.full_name, User.name)
+            )
+            .join(User, User.user_id == UserStats.user_id)
+        )
+        leaderboard.load(result)
+
+
+async def reconcile_leaderboard(interval: float = 300):
+    """Функция для загрузки рейтинга и его периодической сверки с БД.
+    Нужна, чтобы учитывать ответы, сохраненные другими процессами бота."""
+    while True:
+        try:
+            await load_leaderboard()
+        except Exception:
+            logging.exception("Failed to reload leaderboard")
+        await asyncio.sleep(interval)
+
+
+def month_start(day: date, months: int = 0) -> date:
+    """Возвращает первое число месяца, отстоящего от day на months месяцев."""
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+async def create_answer_partitions(months_ahead: int = 2):
+    """Функция для создания секций журнала answer_events на текущий и months_ahead следующих месяцев.
+    Ответы за месяцы без своей секции попадают в секцию по умолчанию answer_events_default."""
+    today = datetime.now(timezone.utc).date()
+
+    async with engine.begin() as connection:
+        await connection.execute(text("CREATE TABLE IF NOT EXISTS answer_events_default PARTITION OF answer_events DEFAULT"))
+
+        for months in range(months_ahead + 1):
+            start = month_start(today, months)
+            end = month_start(today, months + 1)
+            await connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS answer_events_{start:%Y_%m} PARTITION OF answer_events "
+                f"FOR VALUES FROM ('{start}') TO ('{end}')"
+            ))
+
 
-async def update_stats(user_id: int, correct: bool):
-    """Функция для обновления статистики пользователя.
-    Происходит запрос на получение статистики пользователя.
-    Если статистика есть, то обновляется количество правильных и неправильных ответов.
-    Если статистики нет, то создается новая статистика с начальными значениями."""
+async def drop_answer_partitions(retention_months: int) -> list:
+    """Функция для удаления секций журнала answer_events, все ответы которых старше retention_months месяцев.
+    Статистика читается из сводных таблиц, поэтому старые ответы больше не нужны. Возвращает имена удаленных секций."""
+    cutoff = month_start(datetime.now(timezone.utc).date(), -retention_months)
+    dropped = []
+
+    async with engine.begin() as connection:
+        result = await connection.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'answer_events'::regclass"
+        ))
+        for name in result.scalars():
+            try:
+                start = datetime.strptime(name, "answer_events_%Y_%m").date()
+            except ValueError:
+                # Секция по умолчанию не удаляется
+                continue
+            if month_start(start, 1) <= cutoff:
+                await connection.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+
+    return dropped
+
+
+async def maintain_answer_partitions(retention_months: int = 0, interval: float = 24 * 60 * 60):
+    """Функция для периодического создания секций журнала answer_events на следующие месяцы
+    и удаления секций старше retention_months месяцев (0 - секции не удаляются)."""
+    while True:
+        try:
+            await create_answer_partitions()
+        except Exception:
+            logging.exception("Failed to create answer partitions")
+        if retention_months > 0:
+            try:
+                dropped = await drop_answer_partitions(retention_months)
+                if dropped:
+                    logging.info("Dropped old answer partitions", extra={"partitions": dropped})
+            except Exception:
+                logging.exception("Failed to drop answer partitions")
+        await asyncio.sleep(interval)
+
+
+async def create_deck(user_id: int, title: str):
+    """Функция для создания колоды из личных карточек пользователя, которые еще не входят в колоду.
+    Карточки не копируются: у них только заполняется deck_id. Возвращает (ID колоды, количество карточек)
+    или None, если таких карточек нет."""
     async with AsyncSessionLocal() as session:
+        deck = Deck(title=title, owner_id=user_id)
+        session.add(deck)
+        await session.flush()
+
         result = await session.execute(
-            select(UserStats)
-            .filter(UserStats.user_id == user_id)
+            update(Card)
+            .where(Card.owner_id == user_id, Card.deck_id.is_(None))
+            .values(deck_id=deck.id)
+            .returning(Card.id)
         )
-        stats = result.scalars().first()
+        card_ids = list(result.scalars())
+        if not card_ids:
+            await session.rollback()
+            return None
 
-        if stats:
-            if correct:
-                stats.correct_answers += 1
-            else:
-                stats.incorrect_answers += 1
-        else:
-            stats = UserStats(
-                user_id=user_id,
-                correct_answers=1 if correct else 0,
-                incorrect_answers=0 if correct else 1
+        await notify_card_change(session, "share", user_id, deck_id=deck.id)
+        await session.commit()
+
+    for card_id in card_ids:
+        card_index.set_deck(card_id, deck.id)
+
+    return deck.id, len(card_ids)
+
+
+def decks_query(user_id: int, limit: int = 20):
+    """Запрос последних колод: ID, название, владелец, количество карточек (по индексу ix_cards_deck_id_id)
+    и подписан ли пользователь (по первичному ключу deck_subscriptions)."""
+    cards_count = (
+        select(func.count(Card.id))
+        .where(Card.deck_id == Deck.id)
+        .scalar_subquery()
+    )
+    subscribed = exists().where(DeckSubscription.user_id == user_id, DeckSubscription.deck_id == Deck.id)
+    return (
+        select(Deck.id, Deck.title, Deck.owner_id, cards_count, subscribed)
+        .order_by(Deck.id.desc())
+        .limit(limit)
+    )
+
+
+async def get_decks(user_id: int, limit: int = 20):
+    """Функция для получения последних колод. Возвращает список (ID, название, владелец, карточек, подписан)."""
+    async with read_router.session(user_id) as session:
+        result = await session.execute(decks_query(user_id, limit))
+        return result.all()
+
+
+async def subscribe_deck(user_id: int, deck_id: int) -> bool | None:
+    """Функция для подписки пользователя на колоду одной строкой в deck_subscriptions.
+    На собственную колоду подписаться нельзя: ее карточки и так доступны владельцу.
+    Возвращает True, если подписка добавлена, False, если пользователь уже подписан,
+    и None, если колода не найдена (или принадлежит самому пользователю)."""
+    statement = (
+        insert(DeckSubscription)
+        .from_select(
+            ["user_id", "deck_id"],
+            select(literal(user_id, Integer), Deck.id).where(Deck.id == deck_id, Deck.owner_id != user_id)
+        )
+        .on_conflict_do_nothing()
+        .returning(DeckSubscription.deck_id)
+    )
+    async with AsyncSessionLocal() as session:
+        subscribed = (await session.execute(statement)).scalar() is not None
+        if not subscribed:
+            # Вставка пропущена: либо подписка уже есть, либо подписываться не на что
+            deck_exists = await session.scalar(
+                select(exists().where(Deck.id == deck_id, Deck.owner_id != user_id))
             )
-            session.add(stats)
+            return False if deck_exists else None
+        await notify_card_change(session, "subscribe", user_id, deck_id=deck_id)
+        await session.commit()
+
+    read_router.mark_write(user_id)
+    card_index.subscribe(user_id, deck_id)
+    return True
 
+
+async def unsubscribe_deck(user_id: int, deck_id: int):
+    """Функция для отмены подписки пользователя на колоду.
+    В той же транзакции удаляются состояния повторения карточек колоды, чтобы они не попадали в повторение."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            delete(DeckSubscription).where(DeckSubscription.user_id == user_id, DeckSubscription.deck_id == deck_id)
+        )
+        if result.rowcount:
+            await session.execute(
+                delete(CardReview).where(
+                    CardReview.user_id == user_id,
+                    CardReview.card_id.in_(select(Card.id).where(Card.deck_id == deck_id))
+                )
+            )
+            await notify_card_change(session, "unsubscribe", user_id, deck_id=deck_id)
         await session.commit()
 
+    if result.rowcount:
+        read_router.mark_write(user_id)
+        card_index.unsubscribe(user_id, deck_id)
 
-async def get_user_stats(user_id: int):
-    """Функция для получения статистики пользователя."""
+
+async def set_user_blocked(user_id: int, blocked: bool):
+    """Функция для отметки пользователя, который заблокировал бота (или разблокировал его)."""
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(User)
+            .where(User.user_id == user_id)
+            .values(blocked_at=func.now() if blocked else None)
+        )
+        await session.commit()
+
+
+async def create_broadcast(name: str, text: str):
+    """Функция для создания рассылки. Если рассылка с таким именем уже есть, ничего не делает.
+    Возвращает ID новой рассылки или None."""
+    statement = (
+        insert(Broadcast)
+        .values(name=name, text=text)
+        .on_conflict_do_nothing(index_elements=[Broadcast.name])
+        .returning(Broadcast.id)
+    )
+    async with AsyncSessionLocal() as session:
+        broadcast_id = (await session.execute(statement)).scalar()
+        await session.commit()
+    return broadcast_id
+
+
+async def claim_broadcast(lease: timedelta):
+    """Функция для захвата незавершенной рассылки, которую не выполняет другой процесс (или процесс, захвативший ее,
+    не продлил захват вовремя). Рассылка захватывается со случайным токеном, который передается
+    в save_broadcast_progress и release_broadcast. Возвращает (ID, текст, last_user_id, токен) или None."""
+    unclaimed = (
+        select(Broadcast.id)
+        .where(
+            Broadcast.finished_at.is_(None),
+            or_(Broadcast.locked_until.is_(None), Broadcast.locked_until < func.now())
+        )
+        .order_by(Broadcast.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
     async with AsyncSessionLocal() as session:
         result = await session.execute(
-            select(
-                func.sum(UserStats.correct_answers),
-                func.sum(UserStats.incorrect_answers)
+            update(Broadcast)
+            .where(Broadcast.id == unclaimed)
+            .values(locked_until=func.now() + literal(lease, Interval), locked_by=secrets.token_hex(16))
+            .returning(Broadcast.id, Broadcast.text, Broadcast.last_user_id, Broadcast.locked_by)
+        )
+        broadcast = result.first()
+        await session.commit()
+    return broadcast
+
+
+def recipients_query(after_user_id: int, limit: int):
+    """Запрос следующей пачки получателей рассылки по первичному ключу users (keyset-пагинация)."""
+    return (
+        select(User.user_id)
+        .where(User.user_id > after_user_id, User.blocked_at.is_(None))
+        .order_by(User.user_id)
+        .limit(limit)
+    )
+
+
+async def get_recipients(after_user_id: int, limit: int) -> list:
+    """Функция для получения ID следующих limit получателей рассылки после after_user_id."""
+    async with read_router.session() as session:
+        result = await session.execute(recipients_query(after_user_id, limit))
+        return list(result.scalars())
+
+
+async def save_broadcast_progress(
+        broadcast_id: int, token: str, last_user_id: int, sent: int, failed: int, blocked_ids: list, lease: timedelta,
+        finished: bool
+) -> bool:
+    """Функция для сохранения прогресса рассылки после пачки получателей в одной транзакции:
+    сдвигает last_user_id, увеличивает счетчики, продлевает захват рассылки (или завершает ее)
+    и отмечает заблокировавших бота пользователей.
+    Прогресс сохраняется, только если рассылка все еще захвачена с токеном token. Возвращает False, если захват
+    потерян (истек, и рассылку захватил другой процесс): ничего не сохраняется, и рассылку нужно остановить."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.locked_by == token)
+            .values(
+                last_user_id=last_user_id,
+                sent=Broadcast.sent + sent,
+                failed=Broadcast.failed + failed,
+                blocked=Broadcast.blocked + len(blocked_ids),
+                locked_until=None if finished else func.now() + literal(lease, Interval),
+                locked_by=None if finished else token,
+                finished_at=func.now() if finished else None
             )
-            .filter(UserStats.user_id == user_id)
         )
-        stats = result.fetchone()
-        return stats
+        if not result.rowcount:
+            await session.rollback()
+            return False
+
+        if blocked_ids:
+            await session.execute(
+                update(User)
+                .where(User.user_id == any_(bindparam("user_ids", blocked_ids, type_=ARRAY(Integer))))
+                .values(blocked_at=func.now())
+            )
+        await session.commit()
+    return True
+
+
+async def release_broadcast(broadcast_id: int, token: str):
+    """Функция для освобождения захваченной рассылки при остановке бота, чтобы ее сразу продолжил другой процесс.
+    Рассылка освобождается, только если она все еще захвачена с токеном token."""
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.locked_by == token)
+            .values(locked_until=None, locked_by=None)
+        )
+        await session.commit()
+
+
+def shared_card_exists_query():
+    """Запрос наличия общих карточек. Выполняется по частичному индексу ix_cards_shared."""
+    return select(Card.id).filter(Card.owner_id.is_(None)).limit(1)
 
 
 async def add_base_cards():
     """Функция для добавления базовых карточек в модель Card.
     Если базовых карточек нет в БД, то добавляются базовые карточки."""
     async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Card)
-            .join(UserCard, isouter=True)
-            .filter(UserCard.user_id == None)
-        )
+        result = await session.execute(shared_card_exists_query())
         cards = result.scalar()
 
         if not cards:
@@ -0,0 +1,179 @@
+"""Подбор неверных вариантов ответа, похожих на верный.
+
+Слова сравниваются по символьным триграммам: каждое слово превращается в нормированный вектор
+количества триграмм (триграммы хэшируются в DIMENSIONS корзин), а похожесть двух слов - скалярное произведение
+их векторов (косинусная мера). Векторы набора слов хранятся разреженными (WordVectors). Для каждой карточки хранятся DISTRACTORS самых похожих слов
+(таблица card_distractors), поэтому при выборе вариантов ответа похожесть не вычисляется.
+
+Полный пересчет таблицы (например, после импорта карточек из файла): python distractors.py
+"""
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+
+# Длина n-граммы и размерность векторов слов
+NGRAM = 3
+DIMENSIONS = 1024
+
+# Максимальный размер матрицы похожести, которая вычисляется за один раз (элементов)
+MAX_BLOCK = 1 << 24
+
+
+@lru_cache(maxsize=100_000)
+def ngram_columns(word: str) -> tuple:
+    """Номера координат вектора для триграмм слова. Кэшируется, так как слова карточек сравниваются многократно."""
+    text = f" {word.lower()} "
+    return tuple(
+        zlib.crc32(text[start:start + NGRAM].encode()) % DIMENSIONS
+        for start in range(max(1, len(text) - NGRAM + 1))
+    )
+
+
+def ngram_cells(words: list) -> tuple:
+    """Номера слов и координат их триграмм: два массива одинаковой длины."""
+    rows = []
+    columns = []
+    for row, word in enumerate(words):
+        word_columns = ngram_columns(word)
+        rows.extend([row] * len(word_columns))
+        columns.extend(word_columns)
+    return np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64)
+
+
+def vectorize(words: list) -> np.ndarray:
+    """Возвращает матрицу нормированных векторов триграмм слов (len(words) x DIMENSIONS).
+    Используется для небольших пачек слов, с которыми сравнивается набор WordVectors."""
+    rows, columns = ngram_cells(words)
+    vectors = np.zeros((len(words), DIMENSIONS), dtype=np.float32)
+    np.add.at(vectors, (rows, columns), 1)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+    return vectors
+
+
+def word_code(word: str) -> int:
+    """Код слова без учета регистра для исключения совпадающих слов."""
+    return hash(word.lower())
+
+
+class WordVectors:
+    """Набор слов в виде разреженных нормированных векторов триграмм.
+
+    Для каждого слова хранятся только ненулевые координаты (в среднем около длины слова), поэтому набор занимает
+    десятки байт на слово вместо DIMENSIONS * 4. Координаты всех слов лежат подряд: слово i занимает
+    позиции starts[i]:starts[i + 1]. Слова добавляются и удаляются без пересчета остальных;
+    удаленные слова только отмечаются и вычищаются, когда их становится больше половины."""
+
+    def __init__(self, ids: list = (), words: list = ()):
+        self.ids = []
+        self._positions = {}
+        self._columns = np.empty(0, dtype=np.int16)
+        self._weights = np.empty(0, dtype=np.float32)
+        self._starts = np.empty(0, dtype=np.int64)
+        self._codes = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._removed = 0
+        self.add(list(ids), list(words))
+
+    def __len__(self):
+        return len(self.ids) - self._removed
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self._positions
+
+    def add(self, ids: list, words: list):
+        """Добавляет слова words с идентификаторами ids."""
+        if not ids:
+            return
+
+        rows, columns = ngram_cells(words)
+        cells, counts = np.unique(rows * DIMENSIONS + columns, return_counts=True)
+        rows = cells // DIMENSIONS
+        weights = counts.astype(np.float32)
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(ids))).astype(np.float32)
+
+        offset = len(self._columns)
+        for item_id in ids:
+            self._positions[item_id] = len(self.ids)
+            self.ids.append(item_id)
+        self._starts = np.concatenate([self._starts, offset + np.searchsorted(rows, np.arange(len(ids)))])
+        self._columns = np.concatenate([self._columns, (cells % DIMENSIONS).astype(np.int16)])
+        self._weights = np.concatenate([self._weights, weights / norms[rows]])
+        self._codes = np.concatenate([self._codes, np.array([word_code(word) for word in words], dtype=np.int64)])
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+
+    def remove(self, ids: list):
+        """Удаляет слова с идентификаторами ids."""
+        for item_id in ids:
+            position = self._positions.pop(item_id, None)
+            if position is not None:
+                self._alive[position] = False
+                self._removed += 1
+
+        if self._removed * 2 > len(self.ids):
+            alive = np.flatnonzero(self._alive)
+            ends = np.append(self._starts[1:], len(self._columns))
+            keep = np.repeat(self._alive, ends - self._starts)
+            self._columns = self._columns[keep]
+            self._weights = self._weights[keep]
+            self._starts = np.concatenate([[0], np.cumsum((ends - self._starts)[alive])])[:-1].astype(np.int64)
+            self._codes = self._codes[alive]
+            self._alive = self._alive[alive]
+            self.ids = [self.ids[position] for position in alive]
+            self._positions = {item_id: position for position, item_id in enumerate(self.ids)}
+            self._removed = 0
+
+    def most_similar(self, target_words: list, k: int) -> tuple:
+        """Для каждого слова из target_words находит k самых похожих слов набора.
+        Слова, совпадающие со словом из target_words, и удаленные слова не учитываются.
+        Возвращает (позиции в ids, похожесть) - две матрицы len(target_words) x k'
+        с убыванием похожести, где k' = min(k, len(ids)). Отсутствующие значения: позиция -1."""
+        k = min(k, len(self.ids))
+        if not target_words or k == 0:
+            return np.empty((len(target_words), 0), dtype=np.int64), np.empty((len(target_words), 0), dtype=np.float32)
+
+        target_codes = np.array([word_code(word) for word in target_words], dtype=np.int64)
+        positions = np.empty((len(target_words), k), dtype=np.int64)
+        similarity = np.empty((len(target_words), k), dtype=np.float32)
+        block = max(1, MAX_BLOCK // max(len(self._columns), len(self.ids)))
+
+        for start in range(0, len(target_words), block):
+            end = min(start + block, len(target_words))
+            target_vectors = vectorize(target_words[start:end])
+            # Похожесть - сумма произведений по ненулевым координатам каждого слова набора
+            scores = np.add.reduceat(target_vectors[:, self._columns] * self._weights, self._starts, axis=1)
+            scores[target_codes[start:end, None] == self._codes[None, :]] = -1
+            scores[:, ~self._alive] = -1
+
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            positions[start:end] = np.take_along_axis(top, order, axis=1)
+            similarity[start:end] = np.take_along_axis(top_scores, order, axis=1)
+
+        positions[similarity < 0] = -1
+        return positions, similarity
+
+
+def most_similar(target_words: list, pool_words: list, k: int) -> tuple:
+    """Для каждого слова из target_words находит k самых похожих слов из pool_words.
+    Слова, совпадающие со словом из target_words, не учитываются.
+    Возвращает (позиции в pool_words, похожесть) - две матрицы len(target_words) x k'
+    с убыванием похожести, где k' = min(k, len(pool_words)). Отсутствующие значения: позиция -1."""
+    return WordVectors(range(len(pool_words)), pool_words).most_similar(target_words, k)
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    from crud import rebuild_distractors
+    from db_init import engine
+
+    async def main():
+        try:
+            print(f"Distractors saved for {await rebuild_distractors()} cards")
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.types import TelegramObject
+from sqlalchemy import delete, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.future import select
+from sqlalchemy.sql import func
+
+from metrics import FSM_CACHE_MISSES, FSM_CALLS, FSM_FLUSHED_KEYS
+from models import FSMRecord
+
+
+# Колонки первичного ключа таблицы fsm_states в порядке, который возвращает PostgresStorage._key
+KEY_COLUMNS = (
+    FSMRecord.bot_id,
+    FSMRecord.chat_id,
+    FSMRecord.user_id,
+    FSMRecord.thread_id,
+    FSMRecord.business_connection_id,
+    FSMRecord.destiny
+)
+
+
+class _Record:
+    """Состояние и данные FSM одного ключа в локальном кэше."""
+    __slots__ = ("state", "data", "loaded_at")
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], loaded_at: float):
+        self.state = state
+        self.data = data
+        self.loaded_at = loaded_at
+
+
+class PostgresStorage(BaseStorage):
+    """Хранилище FSM в PostgreSQL (таблица fsm_states) с локальным кэшем.
+
+    Прочитанная из БД запись хранится в кэше, пока обрабатываются обновления с ее ключом (acquire/release),
+    поэтому несколько вызовов get_data/update_data при обработке одного сообщения выполняют не больше одного запроса.
+    После обработки последнего такого обновления сохраненная запись удаляется из кэша: состояние могло быть
+    изменено другим процессом, и следующее обновление читает его из БД. Записи, прочитанные вне обработки
+    обновлений, хранятся не дольше cache_ttl секунд.
+    Изменения накапливаются в памяти и сохраняются методом flush одним запросом для всех переданных ключей.
+    FSMFlushMiddleware после обработки обновления сохраняет только ключ этого обновления, при закрытии хранилища
+    сохраняются все измененные ключи. Общей блокировки нет: сохранения одного ключа выполняются по очереди,
+    чтобы более старые данные не записались поверх новых, а сохранения разных ключей - параллельно.
+    Если указан state_ttl, записи, которые не изменялись дольше state_ttl секунд, считаются пустыми
+    и периодически удаляются из БД."""
+
+    def __init__(self, session_factory, cache_ttl: float = 1.0, state_ttl: float = None):
+        self._session_factory = session_factory
+        self.cache_ttl = cache_ttl
+        self.state_ttl = state_ttl
+        self._records = {}
+        self._dirty = set()
+        self._key_locks = {}
+        self._active = {}
+        self._last_sweep = time.monotonic()
+        self._cleanup_task = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> tuple:
+        return (
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            key.thread_id or 0,
+            key.business_connection_id or "",
+            key.destiny
+        )
+
+    def _is_fresh(self, key: tuple, record: _Record) -> bool:
+        return key in self._dirty or key in self._active or time.monotonic() - record.loaded_at < self.cache_ttl
+
+    def acquire(self, storage_key: StorageKey):
+        """Отмечает начало обработки обновления с ключом storage_key: запись ключа остается в кэше до release."""
+        key = self._key(storage_key)
+        self._active[key] = self._active.get(key, 0) + 1
+
+    def release(self, storage_key: StorageKey):
+        """Отмечает конец обработки обновления. Когда обновлений с этим ключом больше нет,
+        запись без несохраненных изменений удаляется из кэша."""
+        key = self._key(storage_key)
+        self._active[key] -= 1
+        if self._active[key]:
+            return
+        del self._active[key]
+        if key not in self._dirty:
+            self._records.pop(key, None)
+
+    async def _get_record(self, storage_key: StorageKey) -> _Record:
+        key = self._key(storage_key)
+        record = self._records.get(key)
+        if record is not None and self._is_fresh(key, record):
+            return record
+
+        if self.state_ttl and self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup())
+
+        FSM_CACHE_MISSES.inc()
+        query = select(FSMRecord.state, FSMRecord.data).filter(tuple_(*KEY_COLUMNS) == key)
+        if self.state_ttl:
+            query = query.filter(FSMRecord.updated_at > func.now() - timedelta(seconds=self.state_ttl))
+
+        async with self._session_factory() as session:
+            row = (await session.execute(query)).first()
+
+        # Пока выполнялся запрос, запись могла быть загружена или изменена другой задачей
+        record = self._records.get(key)
+        if record is not None and self._is_fresh(key, record):
+            return record
+
+        record = _Record(row.state if row else None, dict(row.data) if row else {}, time.monotonic())
+        self._records[key] = record
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        FSM_CALLS.labels("set_state").inc()
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._dirty.add(self._key(key))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        FSM_CALLS.labels("get_state").inc()
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        FSM_CALLS.labels("set_data").inc()
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._dirty.add(self._key(key))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        FSM_CALLS.labels("get_data").inc()
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    @asynccontextmanager
+    async def _key_lock(self, key: tuple):
+        """Блокировка сохранения одного ключа. Удаляется, когда ее никто не ждет."""
+        entry = self._key_locks.get(key)
+        if entry is None:
+            entry = self._key_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[key]
+
+    async def flush(self, keys: Optional[List[StorageKey]] = None) -> None:
+        """Сохраняет измененные ключи keys (по умолчанию все измененные) одним запросом INSERT ... ON CONFLICT.
+        Пустые записи (без состояния и данных) удаляются одним запросом DELETE."""
+        self._sweep()
+
+        keys = self._dirty if keys is None else {self._key(key) for key in keys}
+        # Блокировки берутся в одном порядке, чтобы одновременные сохранения нескольких ключей не ждали друг друга
+        keys = sorted(key for key in keys if key in self._dirty)
+        if not keys:
+            return
+
+        async with AsyncExitStack() as stack:
+            for key in keys:
+                await stack.enter_async_context(self._key_lock(key))
+            await self._write([key for key in keys if key in self._dirty])
+
+    async def _write(self, keys: list) -> None:
+        if not keys:
+            return
+
+        self._dirty.difference_update(keys)
+        rows = []
+        empty_keys = []
+        for key in keys:
+            record = self._records[key]
+            if record.state is None and not record.data:
+                empty_keys.append(key)
+            else:
+                rows.append(dict(zip([column.key for column in KEY_COLUMNS], key), state=record.state, data=record.data.copy()))
+
+        try:
+            async with self._session_factory() as session:
+                if rows:
+                    statement = insert(FSMRecord).values(rows)
+                    statement = statement.on_conflict_do_update(
+                        index_elements=list(KEY_COLUMNS),
+                        set_={"state": statement.excluded.state, "data": statement.excluded.data, "updated_at": func.now()}
+                    )
+                    await session.execute(statement)
+                if empty_keys:
+                    await session.execute(delete(FSMRecord).where(tuple_(*KEY_COLUMNS).in_(empty_keys)))
+                await session.commit()
+        except Exception:
+            self._dirty.update(keys)
+            raise
+
+        FSM_FLUSHED_KEYS.inc(len(keys))
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+        await self.flush()
+
+    def _sweep(self):
+        """Удаляет из кэша устаревшие записи без несохраненных изменений."""
+        now = time.monotonic()
+        if now - self._last_sweep < self.cache_ttl:
+            return
+
+        self._last_sweep = now
+        expired = [
+            key for key, record in self._records.items()
+            if key not in self._dirty and key not in self._active and now - record.loaded_at >= self.cache_ttl
+        ]
+        for key in expired:
+            del self._records[key]
+
+    async def _cleanup(self):
+        while True:
+            try:
+                expired_at = datetime.now(timezone.utc) - timedelta(seconds=self.state_ttl)
+                async with self._session_factory() as session:
+                    await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < expired_at))
+                    await session.commit()
+            except Exception:
+                logging.exception("Failed to delete expired FSM states")
+
+            await asyncio.sleep(self.state_ttl)
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Middleware, которое после обработки обновления сохраняет изменения FSM ключа этого обновления
+    и удаляет запись из кэша хранилища, если ее не используют другие обновления."""
+
+    def __init__(self, storage: PostgresStorage):
+        self.storage = storage
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+
+        self.storage.acquire(context.key)
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await self.storage.flush([context.key])
+            except Exception:
+                # Изменения остаются в памяти и будут сохранены при следующем вызове flush
+                logging.exception("Failed to flush FSM states")
+            finally:
+                self.storage.release(context.key)
@@ -0,0 +1,171 @@
+import math
+import random
+
+
+class _Max:
+    """Значение конечного узла списка, которое больше любого другого значения."""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+
+class _Node:
+    __slots__ = ("value", "next", "width")
+
+    def __init__(self, value, next_nodes: list, widths: list):
+        self.value = value
+        self.next = next_nodes
+        self.width = widths
+
+
+class IndexableSkipList:
+    """Отсортированный список с вставкой, удалением, поиском позиции и получением элемента по позиции за O(log n).
+    Каждая ссылка хранит ширину - количество элементов, которое она пропускает."""
+
+    def __init__(self, expected_size: int = 1_000_000):
+        self._size = 0
+        self._levels = int(1 + math.log(expected_size, 2))
+        self._tail = _Node(_Max(), [], [])
+        self._head = _Node(None, [self._tail] * self._levels, [1] * self._levels)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, position: int):
+        if not 0 <= position < self._size:
+            raise IndexError(position)
+
+        node = self._head
+        position += 1
+        for level in reversed(range(self._levels)):
+            while node.width[level] <= position:
+                position -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def __iter__(self):
+        node = self._head.next[0]
+        while node is not self._tail:
+            yield node.value
+            node = node.next[0]
+
+    def insert(self, value):
+        chain = [None] * self._levels
+        steps_at_level = [0] * self._levels
+        node = self._head
+        for level in reversed(range(self._levels)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = min(self._levels, 1 - int(math.log(1.0 - random.random(), 2.0)))
+        new_node = _Node(value, [None] * levels, [None] * levels)
+        steps = 0
+        for level in range(levels):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self._levels):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, value):
+        chain = [None] * self._levels
+        node = self._head
+        for level in reversed(range(self._levels)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+
+        if chain[0].next[0] is self._tail or chain[0].next[0].value != value:
+            raise KeyError(value)
+
+        levels = len(chain[0].next[0].next)
+        for level in range(levels):
+            previous = chain[level]
+            previous.width[level] += previous.next[level].width[level] - 1
+            previous.next[level] = previous.next[level].next[level]
+        for level in range(levels, self._levels):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def index(self, value) -> int:
+        """Возвращает позицию значения (с нуля). Если значения нет, вызывает KeyError."""
+        position = 0
+        node = self._head
+        for level in reversed(range(self._levels)):
+            while node.next[level].value < value:
+                position += node.width[level]
+                node = node.next[level]
+
+        if node.next[0] is self._tail or node.next[0].value != value:
+            raise KeyError(value)
+        return position
+
+
+class Leaderboard:
+    """Рейтинг пользователей по точности ответов, при равной точности - по количеству ответов.
+    В рейтинг попадают пользователи, у которых не меньше min_answers ответов.
+    Обновление статистики пользователя и поиск его места выполняются за O(log n)."""
+
+    def __init__(self, min_answers: int = 10):
+        self.min_answers = min_answers
+        self._users = {}
+        self._ranking = IndexableSkipList()
+
+    def __len__(self):
+        return len(self._ranking)
+
+    @staticmethod
+    def _sort_key(user_id: int, correct: int, incorrect: int) -> tuple:
+        total = correct + incorrect
+        return -correct / total, -total, user_id
+
+    def set(self, user_id: int, correct: int, incorrect: int, name: str = None):
+        """Устанавливает статистику пользователя."""
+        previous = self._users.get(user_id)
+        if previous is not None:
+            previous_correct, previous_incorrect, previous_name = previous
+            if previous_correct + previous_incorrect >= self.min_answers:
+                self._ranking.remove(self._sort_key(user_id, previous_correct, previous_incorrect))
+            name = name or previous_name
+
+        self._users[user_id] = (correct, incorrect, name)
+        if correct + incorrect >= self.min_answers:
+            self._ranking.insert(self._sort_key(user_id, correct, incorrect))
+
+    def add(self, user_id: int, correct: int, incorrect: int):
+        """Прибавляет ответы к статистике пользователя."""
+        previous_correct, previous_incorrect, name = self._users.get(user_id, (0, 0, None))
+        self.set(user_id, previous_correct + correct, previous_incorrect + incorrect, name)
+
+    def load(self, rows):
+        """Заменяет рейтинг статистикой из rows: (user_id, правильные, неправильные, имя)."""
+        self._users = {}
+        self._ranking = IndexableSkipList()
+        for user_id, correct, incorrect, name in rows:
+            self.set(user_id, correct, incorrect, name)
+
+    def rank(self, user_id: int):
+        """Возвращает место пользователя в рейтинге (с единицы) или None, если пользователя нет в рейтинге."""
+        user = self._users.get(user_id)
+        if user is None or user[0] + user[1] < self.min_answers:
+            return None
+        return self._ranking.index(self._sort_key(user_id, user[0], user[1])) + 1
+
+    def top(self, count: int) -> list:
+        """Возвращает первых count пользователей рейтинга: (место, user_id, имя, правильные, неправильные)."""
+        result = []
+        for position, (_, _, user_id) in enumerate(self._ranking):
+            if position >= count:
+                break
+            correct, incorrect, name = self._users[user_id]
+            result.append((position + 1, user_id, name, correct, incorrect))
+        return result
@@ -0,0 +1,197 @@
+import atexit
+import json
+import logging
+import multiprocessing.util
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from metrics import current_handler
+
+
+# Атрибуты, которые есть у любой записи журнала. Остальные атрибуты (переданные через extra) выводятся как поля JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Форматирует запись журнала в одну строку JSON: время, уровень, логгер, сообщение и поля из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только часть записей с полем event: доля задается для каждого события в rates.
+    Записи уровня WARNING и выше, а также события, которых нет в rates, пропускаются всегда."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or record.levelno >= logging.WARNING or random.random() < rate
+
+
+class HandlerFilter(logging.Filter):
+    """Добавляет в запись имя обработчика обновления, при обработке которого она создана."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "handler"):
+            handler = current_handler()
+            if handler is not None:
+                record.handler = handler
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler с ограниченной очередью, который никогда не блокирует вызывающий поток.
+    Если очередь заполнена, запись отбрасывается. Количество отброшенных записей
+    сообщается предупреждением, как только в очереди снова появляется место."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Форматирование выполняется в потоке QueueListener, здесь только фиксируются сообщение и текст исключения
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        with self._dropped_lock:
+            try:
+                if self.dropped:
+                    self.queue.put_nowait(logging.makeLogRecord({
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": "Log queue overflow, records dropped",
+                        "dropped": self.dropped
+                    }))
+                    self.dropped = 0
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    def reset_queue(self):
+        """Заменяет очередь новой. Используется в дочернем процессе после fork."""
+        self.queue = queue.Queue(self.maxsize)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+
+class DrainingQueueListener(QueueListener):
+    """QueueListener, который при остановке дожидается места в очереди и записывает все накопленные записи.
+    Повторный вызов stop ничего не делает."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+# Настройки файла журнала и поток записи. Заполняются в setup_logging, используются в use_worker_file
+_file_settings = {}
+
+
+def parse_sample_rates(value: str) -> dict:
+    """Разбирает строку вида "answer:0.01, card_shown:0.1" в словарь {событие: доля}."""
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.strip().partition(":")
+        if name:
+            rates[name] = float(rate)
+    return rates
+
+
+def setup_logging(
+        level: str = "INFO",
+        file_name: str = "app.log",
+        max_bytes: int = 1024 * 1024,
+        backup_count: int = 50,
+        queue_size: int = 10_000,
+        sample_rates: dict = None
+) -> DrainingQueueListener:
+    """Настраивает журнал: записи в формате JSON Lines выводятся в консоль и в файл file_name.
+    Вызывающий поток только кладет запись в очередь, запись на диск и ротация файла выполняются в отдельном потоке.
+    В дочерних процессах, созданных через fork, поток записи запускается заново и пишет только в консоль:
+    ротация одного файла из нескольких процессов портит файл и его копии, поэтому процесс выбирает
+    свой файл функцией use_worker_file."""
+    formatter = JSONFormatter()
+    file_handler = RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+    stream_handler = logging.StreamHandler()
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue_size)
+    queue_handler.addFilter(SamplingFilter(sample_rates or {}))
+    queue_handler.addFilter(HandlerFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = DrainingQueueListener(queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_in_child():
+        queue_handler.reset_queue()
+        listener.queue = queue_handler.queue
+        listener.handlers = (stream_handler,)
+        listener._thread = None
+        listener.start()
+        # Процессы multiprocessing завершаются без вызова atexit
+        multiprocessing.util.Finalize(None, listener.stop, exitpriority=0)
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    _file_settings.update(
+        listener=listener,
+        stream_handler=stream_handler,
+        file_name=file_name,
+        max_bytes=max_bytes,
+        backup_count=backup_count
+    )
+    return listener
+
+
+def use_worker_file(worker: int):
+    """Направляет журнал текущего процесса в отдельный файл: app.log -> app.<worker>.log.
+    Вызывается в каждом процессе webhook-сервера."""
+    if not _file_settings:
+        return
+
+    root, extension = os.path.splitext(_file_settings["file_name"])
+    file_handler = RotatingFileHandler(
+        f"{root}.{worker}{extension}",
+        maxBytes=_file_settings["max_bytes"],
+        backupCount=_file_settings["backup_count"],
+        encoding="utf-8",
+        delay=True
+    )
+    file_handler.setFormatter(JSONFormatter())
+    _file_settings["listener"].handlers = (file_handler, _file_settings["stream_handler"])
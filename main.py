@@ -1,51 +1,168 @@
 import asyncio
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
-from db_init import database, init_db
+from db_init import AsyncSessionLocal, check_schema, engine, get_pool_stats, read_router
 
 import logging
-from logging.handlers import RotatingFileHandler
 
+import os
 import random
+import tempfile
+import time
 import configparser
 
-from crud import add_user, add_card, get_cards, delete_card_db, get_random_card, update_stats, get_user_stats
-
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        RotatingFileHandler("app.log", maxBytes=1024*1024, backupCount=50, encoding="utf-8", delay=True),
-        logging.StreamHandler()
-    ]
-)
+from crud import add_user, set_user_blocked, add_card, create_deck, get_decks, subscribe_deck, unsubscribe_deck, get_cards_page, delete_cards, get_random_cards, get_due_card, import_cards, update_stats, get_user_stats, get_daily_stats, get_hardest_cards, load_card_index, load_known_users, reconcile_leaderboard, maintain_answer_partitions, leaderboard, known_users, listen_card_changes, stats_buffer, card_index, ANSWER_OPTIONS
+from question_queue import QuestionQueue, make_question
+from quiz import FINISH, AnsweredNonces, QuizAnswer, answer_position, arrange_options, build_quiz_keyboard, make_key
+from fsm_storage import PostgresStorage, FSMFlushMiddleware
+from rate_limiter import OutboundScheduler
+from broadcast import BroadcastScheduler, parse_time
+from throttling import ThrottlingMiddleware, parse_limit
+from logging_setup import parse_sample_rates, setup_logging
+from metrics import RequestMetricsMiddleware, instrument_dispatcher, instrument_engine, instrument_pool, start_metrics_server
 
 
 # Чтение конфигурационного файла
 config = configparser.ConfigParser()
 config.read('settings.ini')
+
+# Настройка логирования: записи JSON Lines пишутся в консоль и в app.log из отдельного потока
+setup_logging(
+    level=config.get("logging", "level", fallback="INFO"),
+    file_name=config.get("logging", "file", fallback="app.log"),
+    max_bytes=config.getint("logging", "max_bytes", fallback=1024 * 1024),
+    backup_count=config.getint("logging", "backup_count", fallback=50),
+    queue_size=config.getint("logging", "queue_size", fallback=10_000),
+    sample_rates=parse_sample_rates(config.get("logging", "sample_rates", fallback=""))
+)
+# Время обработки обновлений записывает UpdateMetricsMiddleware (событие update)
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
 bot_token = config["tokens"]["bot_token"]
 
+# Режим получения обновлений: polling или webhook
+bot_mode = config.get("bot", "mode", fallback="polling")
+webhook_url = config.get("bot", "webhook_url", fallback="")
+webhook_path = config.get("bot", "webhook_path", fallback="/webhook")
+webhook_secret = config.get("bot", "webhook_secret", fallback="")
+webhook_host = config.get("bot", "webhook_host", fallback="0.0.0.0")
+webhook_port = config.getint("bot", "webhook_port", fallback=8080)
+workers = config.getint("bot", "workers", fallback=1)
+# Адрес Bot API. Если не указан, используется api.telegram.org
+api_server = config.get("bot", "api_server", fallback="")
+
+# Настройки рейтинга пользователей
+leaderboard_size = config.getint("leaderboard", "size", fallback=10)
+leaderboard_reload_interval = config.getfloat("leaderboard", "reload_interval", fallback=300)
+
+# Настройки хранилища состояний FSM
+fsm_cache_ttl = config.getfloat("fsm", "cache_ttl", fallback=1.0)
+fsm_state_ttl = config.getfloat("fsm", "state_ttl", fallback=0) or None
+
+# Лимиты отправки сообщений Telegram (сообщений в секунду). Общий лимит делится между процессами webhook
+rate_limit_global = config.getfloat("rate_limit", "global_rate", fallback=30)
+rate_limit_chat = config.getfloat("rate_limit", "chat_rate", fallback=1)
+rate_limit_chat_burst = config.getfloat("rate_limit", "chat_burst", fallback=3)
+rate_limit_group = config.getfloat("rate_limit", "group_rate", fallback=20 / 60)
+rate_limit_group_burst = config.getfloat("rate_limit", "group_burst", fallback=3)
+rate_limit_retries = config.getint("rate_limit", "max_retries", fallback=3)
+
+# Лимиты частоты обновлений от одного пользователя для групп обработчиков: "обновлений в секунду, запас"
+throttling_limits = {
+    group: parse_limit(config.get("throttling", group, fallback=default))
+    for group, default in (("quiz", "2, 6"), ("cards", "0.5, 5"), ("stats", "0.2, 3"))
+}
+throttling_max_buckets = config.getint("throttling", "max_buckets", fallback=100_000)
+
+# Настройки рассылок: включен ли планировщик рассылок, время ежедневного напоминания (UTC, пустое значение отключает напоминания),
+# размер пачки получателей, количество одновременных отправок и интервал проверки новых рассылок
+broadcast_enabled = config.getboolean("broadcast", "enabled", fallback=True)
+broadcast_reminder_time = parse_time(config.get("broadcast", "reminder_time", fallback=""))
+broadcast_reminder_text = config.get("broadcast", "reminder_text", fallback="")
+broadcast_batch_size = config.getint("broadcast", "batch_size", fallback=500)
+broadcast_concurrency = config.getint("broadcast", "concurrency", fallback=8)
+broadcast_poll_interval = config.getfloat("broadcast", "poll_interval", fallback=60)
+
+# Секрет для проверки ответов в тесте в одном сообщении. Если не указан, используется токен бота
+quiz_key = make_key(config.get("quiz", "secret", fallback="") or bot_token)
+answered_nonces = AnsweredNonces()
+
+# Сколько месяцев хранятся секции журнала ответов answer_events. 0 - секции не удаляются
+answer_retention_months = config.getint("answers", "retention_months", fallback=0)
+
+# Настройки HTTP-сервера метрик Prometheus. Порт 0 отключает сервер.
+# В режиме webhook каждый процесс открывает свой порт: port, port + 1, ...
+metrics_host = config.get("metrics", "host", fallback="0.0.0.0")
+metrics_port = config.getint("metrics", "port", fallback=0)
+
 # Инициализация бота
-dp = Dispatcher()
-bot = Bot(token=bot_token)
+fsm_storage = PostgresStorage(AsyncSessionLocal, cache_ttl=fsm_cache_ttl, state_ttl=fsm_state_ttl)
+dp = Dispatcher(storage=fsm_storage)
+instrument_dispatcher(dp)
+throttling = ThrottlingMiddleware(throttling_limits, max_buckets=throttling_max_buckets)
+dp.message.middleware(throttling)
+dp.callback_query.middleware(throttling)
+dp.update.outer_middleware(FSMFlushMiddleware(fsm_storage))
+bot = Bot(
+    token=bot_token,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+)
+outbound = OutboundScheduler(
+    global_rate=rate_limit_global / (workers if bot_mode == "webhook" else 1),
+    chat_rate=rate_limit_chat,
+    chat_burst=rate_limit_chat_burst,
+    group_rate=rate_limit_group,
+    group_burst=rate_limit_group_burst,
+    max_retries=rate_limit_retries
+)
+bot.session.middleware(outbound)
+bot.session.middleware(RequestMetricsMiddleware())
+broadcasts = BroadcastScheduler(
+    bot,
+    reminder_time=broadcast_reminder_time,
+    reminder_text=broadcast_reminder_text,
+    batch_size=broadcast_batch_size,
+    concurrency=broadcast_concurrency,
+    poll_interval=broadcast_poll_interval
+)
+instrument_engine(engine)
+for replica_engine in read_router.replica_engines:
+    instrument_engine(replica_engine)
+instrument_pool(get_pool_stats)
 
 # Основная клавиатура
 base_keyboard = types.ReplyKeyboardMarkup(
     resize_keyboard=True,
     keyboard=[
-        [types.KeyboardButton(text="📈 Статистика 📈")],
+        [types.KeyboardButton(text="📈 Статистика 📈"), types.KeyboardButton(text="🏆 Лидеры 🏆")],
         [types.KeyboardButton(text="➕ Добавить карточку 📝"), types.KeyboardButton(text="❌ Удалить карточку 📝")],
-        [types.KeyboardButton(text="📚 Запустить тест (случайные карточки) 📚")]
+        [types.KeyboardButton(text="📚 Запустить тест (случайные карточки) 📚"), types.KeyboardButton(text="📦 Колоды 📦")],
+        [types.KeyboardButton(text="🔁 Повторить карточки 🔁"), types.KeyboardButton(text="⚡ Тест в одном сообщении ⚡")]
     ]
 )
 
+
+def build_test_keyboard(words: list) -> types.ReplyKeyboardMarkup:
+    """Создает клавиатуру с вариантами ответов для вопроса теста."""
+    return types.ReplyKeyboardMarkup(
+        resize_keyboard=True,
+        keyboard=[
+            [types.KeyboardButton(text=word) for word in words[:2]],
+            [types.KeyboardButton(text=word) for word in words[2:]],
+            [types.KeyboardButton(text="⏭ Пропустить"), types.KeyboardButton(text="🔚 Завершить")]
+        ]
+    )
+
+
+# Очередь заранее подготовленных вопросов для каждого пользователя
+question_queue = QuestionQueue(get_random_cards, build_test_keyboard)
+
 # Клавиатура отмены
 cancel_keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="❌ Отменить", callback_data='cancel')]
@@ -59,7 +176,7 @@ async def start_command(message: types.Message) -> None:
     await add_user(message.from_user.id, message.from_user.username, message.from_user.full_name)
     await message.answer(f'Привет, {message.from_user.full_name} 👋\n\nРад тебя видеть 😊\n\nВыбери действие из меню.', reply_markup=base_keyboard)
 
-    logging.info(f"User {message.from_user.id} started the bot")
+    logging.info("User started the bot", extra={"event": "start", "user_id": message.from_user.id})
 
 
 class TestState(StatesGroup):
@@ -67,16 +184,24 @@ class TestState(StatesGroup):
     waiting_for_answer = State()
 
 
-@dp.message(F.text == "⏭ Пропустить")
+# Сколько пропущенных карточек review запоминается в состоянии пользователя
+MAX_SKIPPED_CARDS = 100
+
+
+@dp.message(F.text == "⏭ Пропустить", flags={"throttling": "quiz"})
 async def skip_card(message: types.Message, state: FSMContext):
     """Функция для пропуска текущей карточки.
-    Запускает следующую карточку и добавляет количество пропущенных ответов."""
+    Запускает следующую карточку и добавляет количество пропущенных ответов.
+    В режиме review пропущенная карточка запоминается, чтобы get_due_card не вернул ее снова."""
     data = await state.get_data()
     skipped_answers = data.get("skipped_answers", 0) + 1
     await state.update_data(skipped_answers=skipped_answers)
+    if data.get("mode") == "review" and "card_id" in data:
+        skipped_ids = data.get("skipped_ids", []) + [data["card_id"]]
+        await state.update_data(skipped_ids=skipped_ids[-MAX_SKIPPED_CARDS:])
 
     await send_card(message, state)
-    logging.info(f"User {message.from_user.id} skipped a card")
+    logging.info("User skipped a card", extra={"event": "skip", "user_id": message.from_user.id})
 
 
 @dp.message(F.text == "🔚 Завершить")
@@ -103,51 +228,73 @@ async def end_test(message: types.Message, state: FSMContext):
     await message.answer(result_message, reply_markup=base_keyboard)
     await state.clear()
 
-    logging.info(f"User {message.from_user.id} finished the test")
+    logging.info("User finished the test", extra={
+        "event": "test_finished",
+        "user_id": message.from_user.id,
+        "correct": correct_answers,
+        "incorrect": incorrect_answers,
+        "skipped": skipped_answers
+    })
+
+
+@dp.message(F.text == "📚 Запустить тест (случайные карточки) 📚", flags={"throttling": "quiz"})
+async def start_test(message: types.Message, state: FSMContext) -> None:
+    """Запускает тест со случайными карточками."""
+    await state.update_data(mode="random")
+    await send_card(message, state)
+
+
+@dp.message(F.text == "🔁 Повторить карточки 🔁", flags={"throttling": "quiz"})
+async def start_review(message: types.Message, state: FSMContext) -> None:
+    """Запускает тест с карточками, которые пора повторить (интервальное повторение)."""
+    await state.update_data(mode="review", skipped_ids=[])
+    await send_card(message, state)
 
 
-@dp.message(F.text == "📚 Запустить тест (случайные карточки) 📚")
 async def send_card(message: types.Message, state: FSMContext) -> None:
-    """Запускает тест и отправляет пользователю случайную карточку.
-    Из функции get_random_card из crud.py в data возвращается target_card.id, target_card.translate, target_card.target_word, answer_words (случайные слова)."""
+    """Отправляет пользователю следующую карточку теста.
+    В режиме random вопрос берется из очереди question_queue, которая заранее заполняется с помощью get_random_cards из crud.py.
+    В режиме review карточку, которую пора повторить, возвращает get_due_card из crud.py."""
     user_id = message.from_user.id
+    data = await state.get_data()
 
-    data = await get_random_card(user_id)
+    if data.get("mode") == "review":
+        card = await get_due_card(user_id, data.get("skipped_ids", []))
+        question = make_question(card, build_test_keyboard) if card else None
 
-    if not data:
-        await message.answer("❌ Нет доступных карточек для тестирования.")
-        await state.clear()
-        return
+        if not question:
+            await message.answer("✅ Сейчас нет карточек для повторения. Загляни позже.", reply_markup=base_keyboard)
+            await state.clear()
+            return
+    else:
+        question = await question_queue.get(user_id)
+        # Карточка колоды могла быть удалена владельцем после того, как вопрос попал в очередь
+        while question and question.card_id not in card_index.cards:
+            question = await question_queue.get(user_id)
 
-    card_id, translate, target_word, words = data
-    words.append(target_word)
-    random.shuffle(words)
+        if not question:
+            await message.answer("❌ Нет доступных карточек для тестирования.")
+            await state.clear()
+            return
 
     await state.update_data(
-        card_id=card_id,
-        translate=translate,
-        target_word=target_word,
-        words=words
+        card_id=question.card_id,
+        translate=question.translate,
+        target_word=question.target_word,
+        words=question.words
     )
 
     await message.answer(
-        f"Выбери корректный перевод слова: \n'{translate}'",
-        reply_markup=types.ReplyKeyboardMarkup(
-            resize_keyboard=True,
-            keyboard=[
-                [types.KeyboardButton(text=word) for word in words[:2]],
-                [types.KeyboardButton(text=word) for word in words[2:]],
-                [types.KeyboardButton(text="⏭ Пропустить"), types.KeyboardButton(text="🔚 Завершить")]
-            ]
-        )
+        f"Выбери корректный перевод слова: \n'{question.translate}'",
+        reply_markup=question.keyboard
     )
 
     await state.set_state(TestState.waiting_for_answer)
 
-    logging.info(f"User {message.from_user.id} started the test")
+    logging.info("User started the test", extra={"event": "test_started", "user_id": message.from_user.id})
 
 
-@dp.message(TestState.waiting_for_answer)
+@dp.message(TestState.waiting_for_answer, flags={"throttling": "quiz"})
 async def check_answer(message: types.Message, state: FSMContext):
     """Функция для проверки ответа пользователя.
     Проверяет ответ пользователя и обновляет статистику с помощью update_stats из crud.py.
@@ -169,21 +316,113 @@ async def check_answer(message: types.Message, state: FSMContext):
         response_list = ["✅ Правильно!", "✅ Молодец!", "✅ Так держать!", "✅ Всё верно!"]
         response = random.choice(response_list)
         correct_answers += 1
-        await update_stats(user_id, correct=True)
+        await update_stats(user_id, data["card_id"], correct=True)
     else:
         response_list = ["❌ Неправильно!", "❌ Ошибка!", "❌ Близко, но неверно!", "❌ Неверно!"]
         response = f"{random.choice(response_list)} \n\nВерный ответ: \n'{target_word}'"
         incorrect_answers += 1
-        await update_stats(user_id, correct=False)
+        await update_stats(user_id, data["card_id"], correct=False)
 
     await message.answer(response, reply_markup=types.ReplyKeyboardRemove())
     await state.update_data(correct_answers=correct_answers, incorrect_answers=incorrect_answers)
 
-    await asyncio.sleep(0.05)
     await send_card(message, state)
 
-    logging.info(f"User {message.from_user.id} answered the question correctly {user_answer}, target word: {target_word}" if user_answer == target_word
-                 else f"User {message.from_user.id} answered the question incorrectly {user_answer}, target word: {target_word}")
+    logging.info("User answered a question", extra={
+        "event": "answer",
+        "user_id": user_id,
+        "card_id": data["card_id"],
+        "correct": user_answer == target_word,
+        "answer": user_answer
+    })
+
+
+async def quiz_question(user_id: int, correct: int, incorrect: int) -> tuple:
+    """Возвращает текст и клавиатуру следующего вопроса теста в одном сообщении или None, если карточек недостаточно."""
+    question = await question_queue.get(user_id)
+    if not question:
+        return None
+
+    nonce, options = arrange_options(quiz_key, question.card_id, question.target_word, question.words)
+    text = f"Выбери корректный перевод слова: \n'{question.translate}'"
+    return text, build_quiz_keyboard(question.card_id, nonce, options, correct, incorrect)
+
+
+@dp.message(F.text == "⚡ Тест в одном сообщении ⚡", flags={"throttling": "quiz"})
+async def start_quiz(message: types.Message) -> None:
+    """Запускает тест, в котором вопросы и результаты ответов показываются в одном сообщении.
+    Ответы передаются через inline-кнопки, и каждый ответ обрабатывается одним вызовом edit_message_text."""
+    question = await quiz_question(message.from_user.id, 0, 0)
+    if not question:
+        await message.answer("❌ Нет доступных карточек для тестирования.")
+        return
+
+    text, keyboard = question
+    await message.answer(text, reply_markup=keyboard)
+
+    logging.info("User started the quiz", extra={"event": "quiz_started", "user_id": message.from_user.id})
+
+
+@dp.callback_query(QuizAnswer.filter(), flags={"throttling": "quiz"})
+async def answer_quiz(query: types.CallbackQuery, callback_data: QuizAnswer) -> None:
+    """Проверяет ответ по данным кнопки без чтения состояния FSM: номер верного варианта вычисляется
+    функцией answer_position. Результат ответа и следующий вопрос отправляются одним изменением сообщения.
+    answer_callback_query не вызывается: клавиатура заменяется вместе с сообщением.
+    Повторный ответ на тот же вопрос (двойное нажатие) не засчитывается: answered_nonces запоминает отвеченные вопросы."""
+    user_id = query.from_user.id
+    correct = callback_data.correct
+    incorrect = callback_data.incorrect
+
+    if callback_data.option == FINISH:
+        total = correct + incorrect
+        accuracy = round(correct / total * 100, 2) if total else 0
+        await query.message.edit_text(
+            f"📊 *Результаты теста:*\n\n"
+            f"✅ Правильных ответов: *{correct}*\n"
+            f"❌ Неправильных ответов: *{incorrect}*\n"
+            f"🎯 Точность: *{accuracy}%*\n"
+        )
+        logging.info("User finished the quiz", extra={
+            "event": "quiz_finished",
+            "user_id": user_id,
+            "correct": correct,
+            "incorrect": incorrect
+        })
+        return
+
+    if not answered_nonces.add(user_id, callback_data.nonce):
+        await query.answer()
+        return
+
+    card_id = callback_data.card_id
+    is_correct = callback_data.option == answer_position(quiz_key, card_id, callback_data.nonce, ANSWER_OPTIONS)
+    if is_correct:
+        correct += 1
+        verdict = random.choice(["✅ Правильно!", "✅ Молодец!", "✅ Так держать!", "✅ Всё верно!"])
+    else:
+        incorrect += 1
+        verdict = random.choice(["❌ Неправильно!", "❌ Ошибка!", "❌ Близко, но неверно!", "❌ Неверно!"])
+        card = card_index.cards.get(card_id)
+        if card:
+            verdict += f" Верный ответ: '{card[1]}'"
+
+    await update_stats(user_id, card_id, is_correct)
+
+    question = await quiz_question(user_id, correct, incorrect)
+    if not question:
+        await query.message.edit_text(f"{verdict}\n\n❌ Нет доступных карточек для тестирования.")
+        return
+
+    text, keyboard = question
+    await query.message.edit_text(f"{verdict}\n✅ {correct} ❌ {incorrect}\n\n{text}", reply_markup=keyboard)
+
+    logging.info("User answered a question", extra={
+        "event": "answer",
+        "user_id": user_id,
+        "card_id": card_id,
+        "correct": is_correct,
+        "mode": "quiz"
+    })
 
 
 class AddCard(StatesGroup):
@@ -200,21 +439,32 @@ async def add_card_start(message: types.Message, state: FSMContext):
     await state.set_state(AddCard.waiting_info)
     await state.update_data(step=0, card_data={})
 
-    await message.answer("Введите слово на русском:", reply_markup=cancel_keyboard)
+    await message.answer(
+        "Введите слово на русском:\n\n"
+        "📥 Чтобы добавить много карточек сразу, отправьте файл .csv, .tsv или экспорт Anki (.txt): "
+        "в первой колонке слово на русском, во второй - перевод.",
+        reply_markup=cancel_keyboard
+    )
 
-    logging.info(f"User {message.from_user.id} started adding a card")
+    logging.info("User started adding a card", extra={"event": "add_card_started", "user_id": message.from_user.id})
 
 
-@dp.message(AddCard.waiting_info)
+@dp.message(AddCard.waiting_info, F.text, flags={"throttling": "cards"})
 async def process_card_step(message: types.Message, state: FSMContext):
     """ Процесс добавления карточки.
     Пользователь вводит слово на русском и перевод. Карточка сохраняется в БД с помощью add_card из crud.py."""
+    from card_import import MAX_WORD_LENGTH
+
     data = await state.get_data()
     step = data.get("step", 0)
     card_data = data.get("card_data", {})
 
     field_name = CARD_FIELDS[step]
-    card_data[field_name] = message.text
+    word = " ".join(message.text.split())
+    if not word or len(word) > MAX_WORD_LENGTH:
+        await message.answer(f"❌ Слово должно быть не длиннее {MAX_WORD_LENGTH} символов. Попробуйте еще раз:", reply_markup=cancel_keyboard)
+        return
+    card_data[field_name] = word
 
     step += 1
 
@@ -224,66 +474,207 @@ async def process_card_step(message: types.Message, state: FSMContext):
         await message.answer(prompts[step], reply_markup=cancel_keyboard)
     else:
         await add_card(message.from_user.id, card_data["translate"], card_data["target_word"])
+        question_queue.invalidate(message.from_user.id)
         await state.clear()
         await message.answer(f"✅ Карточка '{card_data['translate']}' добавлена!", reply_markup=base_keyboard)
 
-        logging.info(f"User {message.from_user.id} added a card {card_data['translate']}")
+        logging.info("User added a card", extra={"event": "card_added", "user_id": message.from_user.id, "translate": card_data["translate"]})
+
+
+# Максимальный размер файла, который Bot API позволяет скачать
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+
+@dp.message(F.document, flags={"throttling": "cards"})
+async def import_cards_file(message: types.Message, state: FSMContext):
+    """Импорт карточек из файла CSV/TSV или текстового экспорта Anki.
+    Первая колонка - слово на русском, вторая - перевод. Файл скачивается во временный каталог, читается построчно
+    и загружается в БД с помощью import_cards из crud.py. Во время загрузки сообщение с прогрессом обновляется."""
+    from card_import import ImportStats, SUPPORTED_EXTENSIONS, read_cards
+
+    document = message.document
+
+    if not (document.file_name or "").lower().endswith(SUPPORTED_EXTENSIONS):
+        await message.answer("❌ Поддерживаются файлы .csv, .tsv и .txt (экспорт Anki).", reply_markup=base_keyboard)
+        return
+
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.answer("❌ Файл слишком большой. Максимальный размер - 20 МБ.", reply_markup=base_keyboard)
+        return
+
+    await state.clear()
+    progress_message = await message.answer("⏳ Загружаю карточки...")
+    last_progress = time.monotonic()
+
+    async def progress(rows: int):
+        nonlocal last_progress
+        if time.monotonic() - last_progress >= 2:
+            last_progress = time.monotonic()
+            await progress_message.edit_text(f"⏳ Обработано строк: {rows}")
+
+    stats = ImportStats()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cards")
+            await message.bot.download(document, destination=path)
+            added = await import_cards(message.from_user.id, read_cards(path, stats, progress))
+    except Exception:
+        logging.exception("Card import failed", extra={"event": "import_failed", "user_id": message.from_user.id, "file_name": document.file_name})
+        await progress_message.edit_text("❌ Не удалось загрузить карточки из файла.")
+        return
+
+    question_queue.invalidate(message.from_user.id)
+
+    await progress_message.edit_text(
+        f"✅ Импорт завершен.\n\n"
+        f"📄 Прочитано строк: {stats.rows}\n"
+        f"➕ Добавлено карточек: {added}\n"
+        f"⏭ Пропущено (повторы и некорректные строки): {stats.rows - added}"
+    )
+
+    logging.info("User imported cards", extra={
+        "event": "cards_imported",
+        "user_id": message.from_user.id,
+        "file_name": document.file_name,
+        "added": added
+    })
 
 
 class DeleteState(StatesGroup):
     """Состояние для удаления карточек."""
-    waiting_for_card_id = State()
+    selecting_cards = State()
 
 
-@dp.message(F.text == "❌ Удалить карточку 📝")
-async def delete_card(message: types.Message, state: FSMContext):
-    """ Функция для удаления карточки. Пользователю выводится список карточек с помощью get_cards из crud.py.
-    Затем происходит запрос на ввод ID карточки для удаления."""
-    await state.set_state(DeleteState.waiting_for_card_id)
+class CardsPage(CallbackData, prefix="cards"):
+    """Данные кнопок списка карточек для удаления.
+    after - ID карточки, после которой начинается страница (0 - первая страница)."""
+    action: str
+    after: int = 0
+    card_id: int = 0
+
+
+CARDS_PAGE_SIZE = 10
+MAX_SELECTED_CARDS = 100
+
 
-    cards = await get_cards(message.from_user.id)
+async def build_cards_page(user_id: int, selected: list, after: int = 0, before: int = None):
+    """Создает текст и клавиатуру страницы списка карточек для удаления.
+    Страница загружается с помощью get_cards_page из crud.py. Возвращает None, если на странице нет карточек."""
+    cards, has_more = await get_cards_page(user_id, after_id=after, before_id=before, limit=CARDS_PAGE_SIZE)
 
     if not cards:
+        return None
+
+    has_prev = has_more if before is not None else after > 0
+    has_next = True if before is not None else has_more
+    page_after = cards[0].id - 1 if has_prev else 0
+
+    buttons = [
+        [types.InlineKeyboardButton(
+            text=f"{'✅' if card.id in selected else '⬜'} {card.translate} - {card.target_word}"[:60],
+            callback_data=CardsPage(action="toggle", after=page_after, card_id=card.id).pack()
+        )]
+        for card in cards
+    ]
+
+    navigation = []
+    if has_prev:
+        navigation.append(types.InlineKeyboardButton(text="⬅️", callback_data=CardsPage(action="prev", after=page_after).pack()))
+    if has_next:
+        navigation.append(types.InlineKeyboardButton(text="➡️", callback_data=CardsPage(action="next", after=cards[-1].id).pack()))
+    if navigation:
+        buttons.append(navigation)
+
+    buttons.append([types.InlineKeyboardButton(
+        text=f"🗑 Удалить выбранные ({len(selected)})",
+        callback_data=CardsPage(action="delete").pack()
+    )])
+    buttons.append([types.InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")])
+
+    text = f"Выберите карточки для удаления.\nВыбрано: {len(selected)}"
+    return text, types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(F.text == "❌ Удалить карточку 📝", flags={"throttling": "cards"})
+async def delete_card(message: types.Message, state: FSMContext):
+    """ Функция для удаления карточек. Пользователю выводится первая страница списка его карточек.
+    Карточки отмечаются кнопками, страницы переключаются кнопками ⬅️ и ➡️."""
+    page = await build_cards_page(message.from_user.id, [])
+
+    if not page:
         await message.answer("❌ У вас нет карточек для удаления.", reply_markup=base_keyboard)
         await state.clear()
 
-        logging.warning(f"User {message.from_user.id} tried to delete a card, but they had no cards to delete.")
+        logging.warning("User has no cards to delete", extra={"event": "delete_no_cards", "user_id": message.from_user.id})
         return
 
-    await state.update_data(id=[card.id for card in cards])
+    await state.set_state(DeleteState.selecting_cards)
+    await state.update_data(selected=[])
 
-    cards_string = "ID - Слово\n" + "\n".join([f"{card.id} - {card.translate}" for card in cards])
-    await message.answer(f"{cards_string}\n\nУкажите ID карточки для удаления: ", reply_markup=cancel_keyboard)
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard)
 
 
-@dp.message(DeleteState.waiting_for_card_id)
-async def delete_card_process(message: types.Message, state: FSMContext):
-    """ Функция для удаления карточки по ID.
-    После получения ID функция проверяет его на корректность и удаляет карточку из БД с помощью delete_card_db из crud.py."""
+@dp.callback_query(DeleteState.selecting_cards, CardsPage.filter(F.action == "delete"), flags={"throttling": "cards"})
+async def delete_selected_cards(query: types.CallbackQuery, state: FSMContext):
+    """ Функция для удаления выбранных карточек с помощью delete_cards из crud.py."""
     data = await state.get_data()
-    card_id = message.text
+    selected = data.get("selected", [])
+
+    if not selected:
+        await query.answer("❌ Не выбрано ни одной карточки.", show_alert=True)
+        return
 
-    if not await check_value(card_id, data["id"]):
-        await asyncio.sleep(0.5)
-        await message.answer("❌ Указан некорректный ID. Попробуй ещё.", reply_markup=cancel_keyboard)
+    deleted_ids = await delete_cards(query.from_user.id, selected)
+    question_queue.invalidate(query.from_user.id)
+    await state.clear()
+
+    await query.message.edit_text(f"✅ Удалено карточек: {len(deleted_ids)}.")
+    await query.answer()
+    await query.message.answer("Выбери действие из меню.", reply_markup=base_keyboard)
+
+    logging.info("User deleted cards", extra={"event": "cards_deleted", "user_id": query.from_user.id, "card_ids": deleted_ids})
 
-        logging.warning(f"User {message.from_user.id} entered an incorrect card ID for deletion.")
+
+# Переключение страниц объединяется (показывается последняя запрошенная страница), а выбор карточек - нет,
+# чтобы не потерять отметки. Обработчики проверяются в порядке регистрации, то есть снизу вверх
+@dp.callback_query(DeleteState.selecting_cards, CardsPage.filter(), flags={"throttling": "cards", "coalesce": True})
+@dp.callback_query(DeleteState.selecting_cards, CardsPage.filter(F.action == "toggle"), flags={"throttling": "cards"})
+async def browse_cards(query: types.CallbackQuery, callback_data: CardsPage, state: FSMContext):
+    """ Функция для выбора карточек и переключения страниц списка карточек для удаления."""
+    data = await state.get_data()
+    selected = data.get("selected", [])
+    after = callback_data.after
+
+    if callback_data.action == "toggle":
+        if callback_data.card_id in selected:
+            selected.remove(callback_data.card_id)
+        elif len(selected) >= MAX_SELECTED_CARDS:
+            await query.answer(f"❌ Можно выбрать не больше {MAX_SELECTED_CARDS} карточек за раз.", show_alert=True)
+            return
+        else:
+            selected.append(callback_data.card_id)
+        await state.update_data(selected=selected)
+
+    if callback_data.action == "prev":
+        page = await build_cards_page(query.from_user.id, selected, before=after + 1)
     else:
-        await delete_card_db(int(card_id))
-        await state.clear()
-        await message.answer("✅ Карточка удалена.", reply_markup=base_keyboard)
+        page = await build_cards_page(query.from_user.id, selected, after=after)
+
+    # Карточки на странице могли быть удалены, тогда показывается первая страница
+    if not page:
+        page = await build_cards_page(query.from_user.id, selected)
 
-        logging.info(f"User {message.from_user.id} deleted a card with ID {card_id}")
+    if page:
+        text, keyboard = page
+        await query.message.edit_text(text, reply_markup=keyboard)
+    await query.answer()
 
 
-async def check_value(value: str, lst: list):
-    """ Функция для проверки значения. Вызывается в функции delete_card_id.
-    ID должен быть числом и быть в списке lst (карточек пользователя)."""
-    if not value.isdigit():
-        return False
-    if int(value) not in lst:
-        return False
-    return True
+@dp.callback_query(CardsPage.filter())
+async def expired_cards_page(query: types.CallbackQuery):
+    """ Функция для обработки кнопок устаревшего списка карточек."""
+    await query.answer("❌ Список устарел. Откройте удаление карточек заново.", show_alert=True)
 
 
 @dp.callback_query(F.data == "cancel")
@@ -293,7 +684,7 @@ async def cancel(query: types.CallbackQuery, state: FSMContext):
 
     if current_state is None:
         await query.answer("❌ Нет активного процесса для отмены!", show_alert=True)
-        logging.warning(f"User {query.from_user.id} tried to cancel a non-existent process.")
+        logging.warning("User tried to cancel a non-existent process", extra={"event": "cancel_empty", "user_id": query.from_user.id})
         return
 
     await state.clear()
@@ -303,13 +694,14 @@ async def cancel(query: types.CallbackQuery, state: FSMContext):
     await query.answer("Действие отменено")
     await query.message.answer("❌ Действие отменено.", reply_markup=base_keyboard)
 
-    logging.info(f"User {query.from_user.id} canceled a process {current_state}")
+    logging.info("User canceled a process", extra={"event": "cancel", "user_id": query.from_user.id, "state": current_state})
 
 
-@dp.message(F.text == "📈 Статистика 📈")
+@dp.message(F.text == "📈 Статистика 📈", flags={"throttling": "stats"})
 async def get_stat(message: types.Message):
     """Функция для получения статистики пользователя.
-    Статистика содержит количество правильных и неправильных ответов. Их число возвращает get_user_stats из crud.py."""
+    Статистика содержит количество правильных и неправильных ответов. Их число возвращает get_user_stats из crud.py.
+    Также выводятся ответы за последние дни (get_daily_stats) и самые сложные слова (get_hardest_cards)."""
     user_id = message.from_user.id
 
     stats = await get_user_stats(user_id)
@@ -328,13 +720,162 @@ async def get_stat(message: types.Message):
             f"🎯 Точность: *{accuracy}%*\n"
         )
 
+        daily_stats = await get_daily_stats(user_id)
+        if daily_stats:
+            result_message += "\n📅 *Последние 7 дней:*\n" + "\n".join(
+                f"{day:%d.%m}: ✅ {day_correct} ❌ {day_incorrect}" for day, day_correct, day_incorrect in daily_stats
+            ) + "\n"
+
+        hardest_cards = await get_hardest_cards(user_id)
+        if hardest_cards:
+            result_message += "\n🧩 *Самые сложные слова:*\n" + "\n".join(
+                f"{translate} - {target_word}: ❌ {card_incorrect} из {card_correct + card_incorrect}"
+                for translate, target_word, card_correct, card_incorrect in hardest_cards
+            ) + "\n"
+
         await message.answer(result_message, reply_markup=base_keyboard)
 
-        logging.info(f"User {user_id} got statistics. correct: {correct}, incorrect: {incorrect}, accuracy: {accuracy}")
+        logging.info("User got statistics", extra={
+            "event": "stats",
+            "user_id": user_id,
+            "correct": correct,
+            "incorrect": incorrect,
+            "accuracy": accuracy
+        })
     else:
         await message.answer("❌ Пока нет данных для статистики.", reply_markup=base_keyboard)
 
-        logging.warning(f"No statistics found for user {user_id}")
+        logging.warning("No statistics found", extra={"event": "stats_empty", "user_id": user_id})
+
+
+@dp.message(F.text == "🏆 Лидеры 🏆", flags={"throttling": "stats"})
+async def get_leaderboard(message: types.Message):
+    """Функция для получения рейтинга пользователей по точности ответов.
+    Рейтинг хранится в памяти (leaderboard из crud.py), поэтому запрос к БД не выполняется."""
+    user_id = message.from_user.id
+    top = leaderboard.top(leaderboard_size)
+
+    if not top:
+        await message.answer("❌ Пока нет данных для рейтинга.", reply_markup=base_keyboard)
+        return
+
+    lines = []
+    for rank, top_user_id, name, correct, incorrect in top:
+        if not name:
+            known_user = known_users.get(top_user_id)
+            name = (known_user[1] or known_user[0]) if known_user else "Пользователь"
+        accuracy = round(correct / (correct + incorrect) * 100, 2)
+        lines.append(f"{rank}. {name} — 🎯 {accuracy}% ({correct + incorrect} ответов)")
+
+    rank = leaderboard.rank(user_id)
+    if rank:
+        own_rank = f"Твое место: *{rank}* из {len(leaderboard)}"
+    else:
+        own_rank = f"Чтобы попасть в рейтинг, ответь хотя бы на {leaderboard.min_answers} вопросов."
+
+    await message.answer(f"🏆 *Лидеры:*\n\n" + "\n".join(lines) + f"\n\n{own_rank}", reply_markup=base_keyboard)
+
+    logging.info("User got leaderboard", extra={"event": "leaderboard", "user_id": user_id, "rank": rank})
+
+
+class DeckAction(CallbackData, prefix="deck"):
+    """Данные кнопок списка колод: подписка (subscribe) или отмена подписки (unsubscribe)."""
+    action: str
+    deck_id: int
+
+
+async def build_decks_list(user_id: int):
+    """Создает текст и клавиатуру списка последних колод с кнопками подписки.
+    Возвращает None, если колод нет."""
+    decks = await get_decks(user_id)
+    if not decks:
+        return None
+
+    lines = []
+    buttons = []
+    for deck_id, title, owner_id, cards_count, subscribed in decks:
+        if owner_id == user_id:
+            lines.append(f"📦 {title} — {cards_count} карточек (ваша колода)")
+            continue
+        lines.append(f"{'✅' if subscribed else '📦'} {title} — {cards_count} карточек")
+        buttons.append([types.InlineKeyboardButton(
+            text=f"❌ Отписаться: {title}" if subscribed else f"➕ Подписаться: {title}",
+            callback_data=DeckAction(action="unsubscribe" if subscribed else "subscribe", deck_id=deck_id).pack()
+        )])
+
+    text = "Колоды:\n\n" + "\n".join(lines)
+    return text, types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@dp.message(F.text == "📦 Колоды 📦", flags={"throttling": "stats"})
+async def list_decks(message: types.Message):
+    """Функция для вывода списка колод. Карточки колоды становятся доступны в тестах после подписки."""
+    decks_list = await build_decks_list(message.from_user.id)
+    hint = "Чтобы поделиться своими карточками, отправь /share Название колоды"
+
+    if not decks_list:
+        await message.answer(f"❌ Пока нет ни одной колоды.\n{hint}", reply_markup=base_keyboard)
+        return
+
+    text, keyboard = decks_list
+    await message.answer(f"{text}\n\n{hint}", reply_markup=keyboard)
+
+
+@dp.message(Command("share"), flags={"throttling": "cards"})
+async def share_deck(message: types.Message, command: CommandObject):
+    """Функция для создания колоды из личных карточек пользователя с помощью create_deck из crud.py."""
+    title = (command.args or "").strip()[:64]
+    if not title:
+        await message.answer("❌ Укажи название колоды: /share Название колоды", reply_markup=base_keyboard)
+        return
+
+    deck = await create_deck(message.from_user.id, title)
+    if deck is None:
+        await message.answer("❌ Нет личных карточек, которые еще не входят в колоду.", reply_markup=base_keyboard)
+        return
+
+    deck_id, cards_count = deck
+    await message.answer(f"✅ Колода «{title}» создана, карточек: {cards_count}.", reply_markup=base_keyboard)
+
+    logging.info("User created a deck", extra={"event": "deck_created", "user_id": message.from_user.id, "deck_id": deck_id})
+
+
+@dp.callback_query(DeckAction.filter(), flags={"throttling": "cards"})
+async def change_subscription(query: types.CallbackQuery, callback_data: DeckAction):
+    """Функция для подписки на колоду и отмены подписки. Очередь вопросов пользователя сбрасывается."""
+    user_id = query.from_user.id
+
+    if callback_data.action == "subscribe":
+        subscribed = await subscribe_deck(user_id, callback_data.deck_id)
+        if subscribed is None:
+            await query.answer("❌ Колода не найдена.", show_alert=True)
+            return
+        if not subscribed:
+            await query.answer("Вы уже подписаны на эту колоду.")
+            return
+    else:
+        await unsubscribe_deck(user_id, callback_data.deck_id)
+    question_queue.invalidate(user_id)
+
+    decks_list = await build_decks_list(user_id)
+    if decks_list:
+        text, keyboard = decks_list
+        await query.message.edit_text(text, reply_markup=keyboard)
+    await query.answer()
+
+    logging.info(
+        "User changed deck subscription",
+        extra={"event": "deck_" + callback_data.action, "user_id": user_id, "deck_id": callback_data.deck_id}
+    )
+
+
+@dp.my_chat_member(F.chat.type == "private")
+async def chat_member_changed(update: types.ChatMemberUpdated):
+    """Отмечает пользователя, который заблокировал или разблокировал бота. Заблокировавшим бота рассылки не отправляются."""
+    blocked = update.new_chat_member.status == "kicked"
+    await set_user_blocked(update.from_user.id, blocked)
+
+    logging.info("User changed bot status", extra={"event": "bot_blocked" if blocked else "bot_unblocked", "user_id": update.from_user.id})
 
 
 @dp.message()
@@ -342,16 +883,79 @@ async def command(message: types.Message):
     """ Функция для обработки неизвестных команд."""
     await message.answer("❌ Неизвестная команда. \nВоспользутесь меню.", reply_markup=base_keyboard)
 
-    logging.warning(f"User {message.from_user.id} entered an unknown command: {message.text}")
+    logging.warning("Unknown command", extra={"event": "unknown_command", "user_id": message.from_user.id, "text": message.text})
+
+
+@dp.startup()
+async def on_startup(worker: int = 0, broadcasts_enabled: bool = broadcast_enabled):
+    """Загружает карточки и пользователей в память, запускает сохранение статистики и сервер метрик.
+    В режиме webhook вызывается в каждом процессе сервера, worker - номер процесса.
+    Планировщик рассылок запускается в процессе 0, если broadcasts_enabled (по умолчанию - настройка [broadcast] enabled)."""
+    if metrics_port:
+        dp["metrics_server"] = start_metrics_server(metrics_host, metrics_port + worker)
+
+    if bot_mode == "webhook":
+        # Изменения карточек из других процессов применяются к индексу этого процесса
+        dp["card_listener"] = await listen_card_changes(question_queue.invalidate)
+
+    await load_card_index()
+    stats_buffer.start()
+
+    # Кэш пользователей, рейтинг и секции журнала ответов не нужны для обработки первых обновлений,
+    # поэтому загружаются в фоне, чтобы бот начал принимать обновления сразу после загрузки карточек
+    dp["background_tasks"] = [
+        asyncio.create_task(load_known_users()),
+        asyncio.create_task(reconcile_leaderboard(leaderboard_reload_interval))
+    ]
+    if worker == 0:
+        dp["background_tasks"].append(asyncio.create_task(maintain_answer_partitions(answer_retention_months)))
+    if worker == 0 and broadcasts_enabled:
+        dp["background_tasks"].append(asyncio.create_task(broadcasts.run()))
+    if read_router.replicas:
+        dp["background_tasks"].append(asyncio.create_task(read_router.run_checks()))
+
+
+@dp.shutdown()
+async def on_shutdown():
+    """Сохраняет статистику и закрывает соединения с БД."""
+    for task in dp.workflow_data.pop("background_tasks", []):
+        task.cancel()
+
+    await stats_buffer.stop()
+
+    card_listener = dp.workflow_data.pop("card_listener", None)
+    if card_listener:
+        await card_listener.close()
+
+    await engine.dispose()
+    await read_router.dispose()
+    await outbound.close()
+
+    metrics_server = dp.workflow_data.pop("metrics_server", None)
+    if metrics_server:
+        metrics_server.shutdown()
 
 
 async def main():
-    await database.connect()
-    await init_db()
+    await check_schema()
+    await dp.start_polling(bot)
+
+
+async def prepare_webhook():
+    """Проверяет версию схемы БД и регистрирует webhook перед запуском процессов сервера."""
+    await check_schema()
+    await bot.set_webhook(
+        webhook_url, secret_token=webhook_secret or None, allowed_updates=dp.resolve_used_update_types()
+    )
+    await bot.session.close()
+    await engine.dispose()
+
 
-    try:
-        await dp.start_polling(bot)
-    finally:
-        await database.disconnect()
 if __name__ == "__main__":
-    asyncio.run(main())
+    if bot_mode == "webhook":
+        from webhook import run_webhook
+
+        asyncio.run(prepare_webhook())
+        run_webhook(dp, bot, webhook_host, webhook_port, webhook_path, webhook_secret, workers)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,173 @@
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+# Границы корзин гистограмм длительности в секундах
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+UPDATE_DURATION = Histogram(
+    "bot_update_duration_seconds", "Время обработки обновления", ["event_type"], buckets=DURATION_BUCKETS
+)
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика", ["handler"], buckets=DURATION_BUCKETS
+)
+API_REQUEST_DURATION = Histogram(
+    "bot_api_request_duration_seconds", "Время запроса к Bot API", ["method"], buckets=DURATION_BUCKETS
+)
+QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Время выполнения запроса к БД", ["handler", "statement"], buckets=DURATION_BUCKETS
+)
+QUERIES_PER_UPDATE = Histogram(
+    "db_queries_per_update", "Количество запросов к БД при обработке одного обновления",
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+)
+FSM_CALLS = Counter("fsm_storage_calls_total", "Вызовы методов хранилища FSM", ["method"])
+FSM_CACHE_MISSES = Counter("fsm_storage_cache_misses_total", "Чтения состояний FSM из БД")
+FSM_FLUSHED_KEYS = Counter("fsm_storage_flushed_keys_total", "Ключи FSM, сохраненные в БД")
+OUTBOUND_QUEUE_DEPTH = Gauge("bot_outbound_queue_depth", "Сообщения, ожидающие отправки из-за лимитов Telegram")
+OUTBOUND_RETRY_AFTER = Counter("bot_outbound_retry_after_total", "Ответы Telegram retry_after")
+CARD_LISTENER_CONNECTED = Gauge(
+    "bot_card_listener_connected", "Подключена ли подписка на изменения карточек из других процессов (LISTEN)"
+)
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылок по результату отправки", ["result"])
+THROTTLED_UPDATES = Counter(
+    "bot_throttled_updates_total", "Обновления, не обработанные из-за лимита частоты запросов пользователя", ["group", "action"]
+)
+
+# Запросы, выполненные вне обработки обновлений (сохранение статистики, загрузка данных при запуске)
+BACKGROUND = "background"
+
+
+class _UpdateContext:
+    """Обработчик текущего обновления и количество выполненных им запросов к БД."""
+    __slots__ = ("handler", "queries")
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.queries = 0
+
+
+_current_update: ContextVar = ContextVar("current_update", default=None)
+
+
+def current_handler() -> Optional[str]:
+    """Возвращает имя обработчика текущего обновления или None вне обработки обновлений."""
+    update = _current_update.get()
+    return update.handler if update is not None else None
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware для dp.update: измеряет время обработки обновления
+    и количество запросов к БД, которые выполнены при его обработке, и записывает их в журнал (событие update)."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        context = _UpdateContext()
+        token = _current_update.set(context)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            UPDATE_DURATION.labels(event.event_type).observe(elapsed)
+            QUERIES_PER_UPDATE.observe(context.queries)
+            user = data.get("event_from_user")
+            logging.info("Update handled", extra={
+                "event": "update",
+                "user_id": user.id if user else None,
+                "handler": context.handler,
+                "latency_ms": round(elapsed * 1000, 2),
+                "queries": context.queries
+            })
+            _current_update.reset(token)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Middleware для событий (message, callback_query и т. д.): измеряет время работы обработчика по его имени."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        context = _current_update.get()
+        if context is not None:
+            context.handler = name
+
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_DURATION.labels(name).observe(time.perf_counter() - start)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: измеряет время запросов к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            API_REQUEST_DURATION.labels(method.__api_method__).observe(time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("query_start", time.perf_counter())
+    update = _current_update.get()
+    if update is not None:
+        update.queries += 1
+
+    QUERY_DURATION.labels(
+        update.handler if update is not None else BACKGROUND,
+        statement.lstrip().split(None, 1)[0].upper()
+    ).observe(elapsed)
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Подключает к движку SQLAlchemy обработчики событий, которые измеряют время каждого запроса.
+    Запрос относится к обработчику обновления, при обработке которого он выполнен."""
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def instrument_pool(get_pool_stats: Callable[[], dict]):
+    """Добавляет метрики состояния пула соединений. Значения вычисляются при запросе /metrics."""
+    for name in ("size", "checked_in", "checked_out", "overflow", "waiting"):
+        gauge = Gauge(f"db_pool_{name}", f"Пул соединений: {name}")
+        gauge.set_function(lambda name=name: get_pool_stats()[name])
+
+
+def instrument_dispatcher(dp: Dispatcher):
+    """Подключает middleware метрик ко всем событиям диспетчера."""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(HandlerMetricsMiddleware())
+
+
+def start_metrics_server(host: str, port: int):
+    """Запускает HTTP-сервер /metrics в отдельном потоке, чтобы запросы Prometheus не занимали цикл событий.
+    Возвращает сервер, который останавливается методом shutdown."""
+    server, _ = start_http_server(port, addr=host)
+    logging.info("Metrics server started", extra={"host": host, "port": port})
+    return server
@@ -0,0 +1,132 @@
+"""Миграции схемы БД.
+
+Каждая миграция - корутина, которая получает соединение и выполняется в отдельной транзакции
+вместе с обновлением версии в таблице schema_version. Номер версии равен количеству примененных миграций.
+Новые миграции добавляются в конец списка MIGRATIONS, после чего увеличивается db_init.SCHEMA_VERSION.
+
+Запуск (перед запуском бота после обновления кода): python migrations.py
+"""
+import asyncio
+import logging
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.sql import func
+
+from crud import add_base_cards, create_answer_partitions
+from db_init import SCHEMA_VERSION, engine
+from models import Base, Broadcast, CardDistractor, Deck, DeckSubscription, SchemaVersion
+
+
+# Ключ advisory-блокировки, чтобы миграции не выполнялись одновременно из нескольких процессов
+MIGRATION_LOCK_ID = 7_413_306
+
+
+async def initial_schema(connection: AsyncConnection):
+    """Создает таблицы, которых еще нет. В существующих БД, созданных до появления миграций, ничего не меняет."""
+    await connection.run_sync(Base.metadata.create_all)
+
+
+async def card_owner(connection: AsyncConnection):
+    """Добавляет владельца карточки cards.owner_id (вместо поиска общих карточек через отсутствие строки в users_cards)
+    и индексы для карточек пользователя и общих карточек. Владелец существующих карточек берется из users_cards."""
+    await connection.execute(text(
+        "ALTER TABLE cards ADD COLUMN IF NOT EXISTS owner_id INTEGER REFERENCES users (user_id) ON DELETE CASCADE"
+    ))
+    await connection.execute(text(
+        "UPDATE cards c SET owner_id = uc.user_id FROM users_cards uc WHERE uc.card_id = c.id AND c.owner_id IS NULL"
+    ))
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_cards_owner_id_id ON cards (owner_id, id) INCLUDE (translate, target_word)"
+    ))
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_cards_shared ON cards (id) INCLUDE (translate, target_word) WHERE owner_id IS NULL"
+    ))
+    await connection.execute(text("ANALYZE cards"))
+
+
+async def card_distractors(connection: AsyncConnection):
+    """Создает таблицу похожих карточек card_distractors. Таблица заполняется командой python distractors.py."""
+    await connection.run_sync(CardDistractor.__table__.create, checkfirst=True)
+
+
+async def decks(connection: AsyncConnection):
+    """Создает колоды decks, подписки deck_subscriptions и колонку cards.deck_id с индексом для карточек колоды."""
+    await connection.run_sync(Deck.__table__.create, checkfirst=True)
+    await connection.run_sync(DeckSubscription.__table__.create, checkfirst=True)
+    await connection.execute(text(
+        "ALTER TABLE cards ADD COLUMN IF NOT EXISTS deck_id INTEGER REFERENCES decks (id) ON DELETE SET NULL"
+    ))
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_cards_deck_id_id ON cards (deck_id, id) INCLUDE (translate, target_word) "
+        "WHERE deck_id IS NOT NULL"
+    ))
+
+
+async def broadcasts(connection: AsyncConnection):
+    """Создает таблицу рассылок broadcasts и колонку users.blocked_at."""
+    await connection.run_sync(Broadcast.__table__.create, checkfirst=True)
+    await connection.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP WITH TIME ZONE"))
+
+
+async def broadcast_owner(connection: AsyncConnection):
+    """Добавляет токен захвата рассылки broadcasts.locked_by: прогресс сохраняет только процесс, который ее захватил."""
+    await connection.execute(text("ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS locked_by VARCHAR"))
+
+
+MIGRATIONS = [
+    initial_schema,
+    card_owner,
+    card_distractors,
+    decks,
+    broadcasts,
+    broadcast_owner
+]
+
+assert len(MIGRATIONS) == SCHEMA_VERSION, "db_init.SCHEMA_VERSION must match the number of migrations"
+
+
+async def get_version(connection: AsyncConnection) -> int:
+    """Возвращает текущую версию схемы (0 для новой БД)."""
+    return (await connection.execute(select(SchemaVersion.version))).scalar() or 0
+
+
+async def migrate():
+    """Применяет недостающие миграции, создает секции журнала ответов и добавляет базовые карточки."""
+    async with engine.connect() as connection:
+        await connection.run_sync(SchemaVersion.__table__.create, checkfirst=True)
+        await connection.execute(select(func.pg_advisory_lock(MIGRATION_LOCK_ID)))
+        await connection.commit()
+
+        try:
+            version = await get_version(connection)
+            await connection.commit()
+
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                async with connection.begin():
+                    await migration(connection)
+                    await connection.execute(
+                        insert(SchemaVersion)
+                        .values(id=1, version=number)
+                        .on_conflict_do_update(index_elements=[SchemaVersion.id], set_={"version": number, "applied_at": func.now()})
+                    )
+                logging.info("Migration applied", extra={"version": number, "migration": migration.__name__})
+        finally:
+            await connection.execute(select(func.pg_advisory_unlock(MIGRATION_LOCK_ID)))
+            await connection.commit()
+
+    await create_answer_partitions()
+    await add_base_cards()
+
+
+async def main():
+    try:
+        await migrate()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
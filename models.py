@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table
+from sqlalchemy import Column, Integer, BigInteger, Boolean, Float, String, Date, DateTime, ForeignKey, Index, Table
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -12,6 +14,8 @@ class User(Base):
     user_id = Column(Integer, primary_key=True)
     name = Column(String)
     full_name = Column(String)
+    # Время, когда пользователь заблокировал бота. Такие пользователи пропускаются при рассылках
+    blocked_at = Column(DateTime(timezone=True), nullable=True)
 
     cards = relationship("UserCard", back_populates="user", cascade="all, delete-orphan")
     stats = relationship("UserStats", back_populates="user", cascade="all, delete-orphan")
@@ -23,9 +27,42 @@ class Card(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     translate = Column(String)
     target_word = Column(String)
+    # Владелец карточки. NULL - общая карточка, доступная всем пользователям.
+    # Дублирует users_cards, чтобы карточки пользователя и общие карточки выбирались по индексу без соединения таблиц
+    owner_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=True)
+    # Колода, в которую владелец добавил карточку. Карточки колоды доступны всем подписчикам без копирования
+    deck_id = Column(Integer, ForeignKey("decks.id", ondelete="SET NULL"), nullable=True)
 
     users = relationship("UserCard", back_populates="card", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_cards_owner_id_id", "owner_id", "id", postgresql_include=["translate", "target_word"]),
+        Index("ix_cards_shared", "id", postgresql_include=["translate", "target_word"], postgresql_where=owner_id.is_(None)),
+        Index(
+            "ix_cards_deck_id_id", "deck_id", "id",
+            postgresql_include=["translate", "target_word"], postgresql_where=deck_id.isnot(None)
+        ),
+    )
+
+
+class Deck(Base):
+    """Колода карточек пользователя, на которую могут подписаться другие пользователи."""
+    __tablename__ = "decks"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    title = Column(String, nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class DeckSubscription(Base):
+    """Подписка пользователя на колоду: одна строка вместо копий карточек колоды."""
+    __tablename__ = "deck_subscriptions"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    # Индекс нужен для подсчета подписчиков и каскадного удаления при удалении колоды
+    deck_id = Column(Integer, ForeignKey("decks.id", ondelete="CASCADE"), primary_key=True, index=True)
+
 
 class UserCard(Base):
     __tablename__ = "users_cards"
@@ -45,3 +82,110 @@ class UserStats(Base):
     incorrect_answers = Column(Integer, default=0)
 
     user = relationship("User", back_populates="stats")
+
+
+class CardReview(Base):
+    """Состояние интервального повторения карточки пользователем (алгоритм SM-2)."""
+    __tablename__ = "card_reviews"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    card_id = Column(Integer, ForeignKey("cards.id", ondelete="CASCADE"), primary_key=True)
+    repetitions = Column(Integer, nullable=False, default=0)
+    interval = Column(Float, nullable=False, default=0)
+    ease = Column(Float, nullable=False, default=2.5)
+    next_due = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_card_reviews_user_id_next_due", "user_id", "next_due"),
+    )
+
+
+class AnswerEvent(Base):
+    """Журнал ответов пользователей. Записи только добавляются, таблица секционирована по месяцам."""
+    __tablename__ = "answer_events"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    answered_at = Column(DateTime(timezone=True), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    card_id = Column(Integer, nullable=False)
+    correct = Column(Boolean, nullable=False)
+
+    __table_args__ = {"postgresql_partition_by": "RANGE (answered_at)"}
+
+
+class UserDailyStats(Base):
+    """Количество ответов пользователя за день."""
+    __tablename__ = "user_daily_stats"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    correct_answers = Column(Integer, nullable=False, default=0)
+    incorrect_answers = Column(Integer, nullable=False, default=0)
+
+
+class CardStats(Base):
+    """Количество ответов пользователя по карточке.
+    Внешнего ключа на cards нет: карточка может быть удалена до сохранения накопленных ответов."""
+    __tablename__ = "card_stats"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    card_id = Column(Integer, primary_key=True)
+    correct_answers = Column(Integer, nullable=False, default=0)
+    incorrect_answers = Column(Integer, nullable=False, default=0)
+
+
+class FSMRecord(Base):
+    __tablename__ = "fsm_states"
+
+    bot_id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    thread_id = Column(BigInteger, primary_key=True, default=0)
+    business_connection_id = Column(String, primary_key=True, default="")
+    destiny = Column(String, primary_key=True, default="default")
+    state = Column(String, nullable=True)
+    data = Column(JSONB, nullable=False, default=dict)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), index=True)
+
+
+class SchemaVersion(Base):
+    """Версия схемы БД. Таблица содержит одну строку, которую обновляет migrations.py."""
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True, default=1)
+    version = Column(Integer, nullable=False)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class CardDistractor(Base):
+    """Неверные варианты ответа для карточки: карточки с похожим словом target_word (distractors.py)."""
+    __tablename__ = "card_distractors"
+
+    card_id = Column(Integer, ForeignKey("cards.id", ondelete="CASCADE"), primary_key=True)
+    # Индекс нужен для каскадного удаления строк при удалении карточки-варианта
+    distractor_id = Column(Integer, ForeignKey("cards.id", ondelete="CASCADE"), primary_key=True, index=True)
+    similarity = Column(Float, nullable=False)
+
+
+class Broadcast(Base):
+    """Рассылка всем пользователям (broadcast.py). Прогресс сохраняется после каждой пачки получателей,
+    поэтому прерванная рассылка продолжается с last_user_id."""
+    __tablename__ = "broadcasts"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Уникальное имя, например reminder:2024-01-31, чтобы одна рассылка не создавалась дважды
+    name = Column(String, nullable=False, unique=True)
+    text = Column(String, nullable=False)
+    last_user_id = Column(BigInteger, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    # Рассылку выполняет процесс, который захватил ее до locked_until со случайным токеном locked_by
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    locked_by = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_broadcasts_unfinished", "id", postgresql_where=finished_at.is_(None)),
+    )
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import random
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, NamedTuple
+
+
+class Question(NamedTuple):
+    """Подготовленный вопрос теста: карточка, перемешанные варианты ответов и готовая клавиатура."""
+    card_id: int
+    translate: str
+    target_word: str
+    words: list
+    keyboard: Any
+
+
+def make_question(card: tuple, build_keyboard: Callable[[list], Any]) -> Question:
+    """Создает вопрос из карточки (card_id, translate, target_word, answer_words):
+    добавляет верный ответ к вариантам, перемешивает их и строит клавиатуру."""
+    card_id, translate, target_word, words = card
+    words = words + [target_word]
+    random.shuffle(words)
+    return Question(card_id, translate, target_word, words, build_keyboard(words))
+
+
+class UserQuestions:
+    """Вопросы одного пользователя и задача их пополнения."""
+
+    __slots__ = ("questions", "refill")
+
+    def __init__(self):
+        self.questions = deque()
+        self.refill = None
+
+
+class QuestionQueue:
+    """Очередь заранее подготовленных вопросов для каждого пользователя.
+    Когда в очереди остается мало вопросов, она пополняется в фоне одним вызовом loader.
+    При добавлении или удалении карточек очередь пользователя нужно сбросить через invalidate.
+    Хранится не больше max_users очередей: при превышении удаляются очереди пользователей,
+    которые дольше всех не проходили тест."""
+
+    def __init__(
+            self,
+            loader: Callable[[int, int], Awaitable[list]],
+            build_keyboard: Callable[[list], Any],
+            size: int = 10,
+            low_watermark: int = 3,
+            max_users: int = 10_000
+    ):
+        self._loader = loader
+        self._build_keyboard = build_keyboard
+        self._size = size
+        self._low_watermark = low_watermark
+        self._max_users = max_users
+        self._users = OrderedDict()
+        # Фоновые пополнения, на которые нужно хранить ссылки до их завершения
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._users)
+
+    def _user(self, user_id: int) -> UserQuestions:
+        user = self._users.get(user_id)
+        if user is not None:
+            self._users.move_to_end(user_id)
+            return user
+
+        user = self._users[user_id] = UserQuestions()
+        if len(self._users) > self._max_users:
+            self._users.popitem(last=False)
+        return user
+
+    async def get(self, user_id: int):
+        """Возвращает следующий вопрос для пользователя или None, если карточек недостаточно."""
+        user = self._user(user_id)
+
+        if not user.questions:
+            await self._refill(user_id, user)
+            if not user.questions:
+                return None
+
+        question = user.questions.popleft()
+
+        if len(user.questions) <= self._low_watermark and user.refill is None:
+            user.refill = asyncio.create_task(self._refill(user_id, user))
+            self._tasks.add(user.refill)
+            user.refill.add_done_callback(lambda task: self._on_refill_done(task, user_id, user))
+
+        return question
+
+    def invalidate(self, user_id: int):
+        """Сбрасывает очередь пользователя. Незавершенное фоновое пополнение будет отброшено."""
+        self._users.pop(user_id, None)
+
+    def _on_refill_done(self, task: asyncio.Task, user_id: int, user: UserQuestions):
+        self._tasks.discard(task)
+        user.refill = None
+        if not task.cancelled() and task.exception():
+            logging.error("Failed to refill questions", exc_info=task.exception(), extra={"user_id": user_id})
+
+    async def _refill(self, user_id: int, user: UserQuestions):
+        count = self._size - len(user.questions)
+
+        cards = await self._loader(user_id, count)
+
+        # Очередь сброшена или вытеснена, пока загружались вопросы
+        if self._users.get(user_id) is not user:
+            return
+
+        user.questions.extend(make_question(card, self._build_keyboard) for card in cards)
@@ -0,0 +1,86 @@
+import hashlib
+import random
+from collections import OrderedDict, deque
+
+from aiogram import types
+from aiogram.filters.callback_data import CallbackData
+
+
+# Значение option для кнопки завершения теста
+FINISH = -1
+
+
+class QuizAnswer(CallbackData, prefix="quiz"):
+    """Ответ на вопрос теста в одном сообщении: карточка, одноразовое число вопроса, номер выбранного варианта
+    и счетчики ответов с начала теста. Текст вариантов в данные кнопки не передается."""
+    card_id: int
+    nonce: int
+    option: int
+    correct: int = 0
+    incorrect: int = 0
+
+
+class AnsweredNonces:
+    """Одноразовые числа вопросов, на которые пользователь уже ответил, чтобы повторное нажатие кнопки
+    (двойное нажатие или повтор старого callback) не засчитывалось еще раз.
+    Для каждого пользователя хранится не больше per_user последних nonce, пользователей - не больше max_users:
+    при превышении удаляются пользователи, которые дольше всего не отвечали."""
+
+    def __init__(self, per_user: int = 64, max_users: int = 100_000):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()
+
+    def add(self, user_id: int, nonce: int) -> bool:
+        """Запоминает ответ на вопрос nonce. Возвращает False, если ответ на этот вопрос уже был."""
+        nonces = self._users.get(user_id)
+        if nonces is None:
+            nonces = self._users[user_id] = deque(maxlen=self.per_user)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+
+        if nonce in nonces:
+            return False
+        nonces.append(nonce)
+        return True
+
+
+def make_key(secret: str) -> bytes:
+    """Создает ключ для answer_position из секретной строки."""
+    return hashlib.blake2s(secret.encode()).digest()
+
+
+def answer_position(key: bytes, card_id: int, nonce: int, options: int) -> int:
+    """Номер варианта с верным ответом. Вычисляется ключевым хэшем от карточки и nonce,
+    поэтому проверка ответа не требует хранить вопрос, а подобрать верный номер по данным кнопок нельзя."""
+    digest = hashlib.blake2s(f"{card_id}:{nonce}".encode(), key=key, digest_size=8).digest()
+    return int.from_bytes(digest, "big") % options
+
+
+def arrange_options(key: bytes, card_id: int, target_word: str, words: list) -> tuple:
+    """Выбирает nonce и переставляет варианты так, чтобы верный ответ стоял на позиции answer_position.
+    words - варианты ответа вместе с верным. Возвращает (nonce, варианты)."""
+    nonce = random.getrandbits(32)
+    options = list(words)
+    options.remove(target_word)
+    options.insert(answer_position(key, card_id, nonce, len(words)), target_word)
+    return nonce, options
+
+
+def build_quiz_keyboard(card_id: int, nonce: int, options: list, correct: int, incorrect: int) -> types.InlineKeyboardMarkup:
+    """Создает клавиатуру вопроса: варианты ответа по два в ряд и кнопка завершения теста."""
+    buttons = [
+        types.InlineKeyboardButton(
+            text=word,
+            callback_data=QuizAnswer(card_id=card_id, nonce=nonce, option=option, correct=correct, incorrect=incorrect).pack()
+        )
+        for option, word in enumerate(options)
+    ]
+    rows = [buttons[index:index + 2] for index in range(0, len(buttons), 2)]
+    rows.append([types.InlineKeyboardButton(
+        text="🔚 Завершить",
+        callback_data=QuizAnswer(card_id=0, nonce=0, option=FINISH, correct=correct, incorrect=incorrect).pack()
+    )])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
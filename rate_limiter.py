@@ -0,0 +1,208 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import OUTBOUND_QUEUE_DEPTH, OUTBOUND_RETRY_AFTER
+
+
+# Приоритеты исходящих сообщений: ответы пользователям отправляются раньше массовых рассылок
+INTERACTIVE = 0
+BULK = 1
+
+# Префиксы методов Bot API, которые отправляют или изменяют сообщения и поэтому ограничены лимитами Telegram
+LIMITED_METHOD_PREFIXES = ("send", "edit", "copy", "forward")
+
+_priority: ContextVar = ContextVar("outbound_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_priority():
+    """Контекст, в котором сообщения отправляются с низким приоритетом (массовые рассылки)."""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity в запасе.
+    Токен резервируется сразу, а вызывающий ждет, пока он станет доступен. Поэтому одновременные
+    вызовы reserve не требуют блокировки и получают токены в порядке вызова."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Возвращает, через сколько секунд будет доступен токен."""
+        now = time.monotonic()
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать перед его использованием."""
+        delay = self.delay()
+        self.tokens -= 1
+        return delay
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов на seconds секунд (ответ Telegram retry_after)."""
+        now = time.monotonic()
+        self._refill(now)
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    @property
+    def idle(self) -> bool:
+        """Корзина полна, то есть не отличается от новой."""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота, которое соблюдает лимиты Telegram на отправку сообщений.
+
+    Каждое сообщение сначала ждет токен корзины своего чата (личные чаты и группы ограничены по-разному),
+    затем токен общей корзины бота. Общие токены выдаются в порядке приоритета: ответы пользователям
+    раньше массовых рассылок (bulk_priority), при равном приоритете - в порядке очереди.
+    При ответе TelegramRetryAfter чат (или весь бот, если чата нет) приостанавливается на retry_after секунд,
+    и запрос повторяется до max_retries раз. Остальные методы Bot API выполняются без ограничений."""
+
+    def __init__(
+            self,
+            global_rate: float = 30,
+            chat_rate: float = 1,
+            chat_burst: float = 3,
+            group_rate: float = 20 / 60,
+            group_burst: float = 3,
+            max_retries: int = 3,
+            max_chats: int = 100_000
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, max(1.0, global_rate / 10))
+        self._chats = OrderedDict()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump = None
+        OUTBOUND_QUEUE_DEPTH.set_function(lambda: self.depth)
+
+    @property
+    def depth(self) -> int:
+        """Количество сообщений, которые ждут общего токена."""
+        return len(self._waiters)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+
+        is_private = isinstance(chat_id, int) and chat_id > 0
+        bucket = TokenBucket(
+            self.chat_rate if is_private else self.group_rate,
+            self.chat_burst if is_private else self.group_burst
+        )
+        self._chats[chat_id] = bucket
+
+        if len(self._chats) > self.max_chats:
+            oldest_id, oldest = next(iter(self._chats.items()))
+            if oldest.idle:
+                del self._chats[oldest_id]
+        return bucket
+
+    async def _acquire(self, chat_id, priority: int):
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.reserve()
+            # Пока сообщение ждало, чат мог быть приостановлен ответом retry_after
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = bucket.paused_until - time.monotonic()
+
+        if not self._waiters and self._global.delay() == 0:
+            self._global.reserve()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run())
+        self._wakeup.set()
+        await future
+
+    async def _run(self):
+        """Выдает общие токены ожидающим сообщениям в порядке приоритета."""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global.reserve()
+                future.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        if not method.__api_method__.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        priority = _priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                attempt += 1
+                OUTBOUND_RETRY_AFTER.inc()
+                if attempt > self.max_retries:
+                    raise
+
+                logging.warning("Telegram flood limit", extra={
+                    "chat_id": chat_id,
+                    "method": method.__api_method__,
+                    "retry_after": error.retry_after
+                })
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(error.retry_after)
+
+    async def close(self):
+        """Останавливает выдачу токенов. Ожидающие сообщения отменяются."""
+        if self._pump is not None:
+            self._pump.cancel()
+            self._pump = None
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters = []
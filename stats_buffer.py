@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+
+class StatsBuffer:
+    """Накопитель ответов пользователей в памяти процесса.
+    Собирает ответы (user_id, card_id, correct, answered_at) и сохраняет их одной транзакцией
+    по таймеру или при достижении max_pending ответов в буфере.
+    Для каждого пользователя хранит несохраненные приращения правильных и неправильных ответов.
+
+    Если пачка отклонена ошибкой из permanent_errors (например, нарушение внешнего ключа), ответы сохраняются
+    по пользователям, и отбрасываются только ответы пользователей, которых не удалось сохранить.
+    При других ошибках ответы возвращаются в буфер, но в нем хранится не больше max_buffered ответов."""
+
+    def __init__(
+            self,
+            save: Callable[[list], Awaitable[None]],
+            flush_interval: float = 5.0,
+            max_pending: int = 1000,
+            max_buffered: int = 100_000,
+            permanent_errors: tuple = ()
+    ):
+        self._save = save
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._max_buffered = max_buffered
+        self._permanent_errors = permanent_errors
+        self._events = []
+        self._pending = {}
+        self._saving = {}
+        # ID карточек с несохраненными (и сохраняемыми) ответами по пользователям
+        self._cards = {}
+        self._saving_cards = {}
+        self._saves = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.lock = asyncio.Lock()
+        self._timer = None
+        self._flush_task = None
+
+    def add(self, user_id: int, card_id: int, correct: bool):
+        """Добавляет ответ пользователя в буфер."""
+        self._add_events([(user_id, card_id, correct, datetime.now(timezone.utc))])
+
+        if len(self._events) >= self._max_pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.flush())
+            self._flush_task.add_done_callback(self._on_flush_done)
+
+    def _add_events(self, events: list):
+        self._events.extend(events)
+        for user_id, card_id, correct, _ in events:
+            deltas = self._pending.setdefault(user_id, [0, 0])
+            deltas[0 if correct else 1] += 1
+            self._cards.setdefault(user_id, set()).add(card_id)
+
+    def pending(self, user_id: int) -> tuple:
+        """Возвращает еще не сохраненные приращения пользователя: (правильные, неправильные),
+        включая ответы, которые сохраняются в данный момент."""
+        correct, incorrect = self._pending.get(user_id, (0, 0))
+        saving_correct, saving_incorrect = self._saving.get(user_id, (0, 0))
+        return correct + saving_correct, incorrect + saving_incorrect
+
+    def pending_cards(self, user_id: int) -> set:
+        """Возвращает ID карточек, ответы пользователя на которые еще не сохранены (включая сохраняемые)."""
+        return self._cards.get(user_id, set()) | self._saving_cards.get(user_id, set())
+
+    async def read_consistent(self, user_id: int, read: Callable[[], Awaitable]) -> tuple:
+        """Выполняет чтение сохраненной статистики read() и возвращает (результат, pending(user_id)) так,
+        чтобы ответы не были учтены дважды или пропущены. Блокировка на время чтения не берется:
+        если во время чтения началось сохранение, чтение повторяется после его завершения."""
+        while True:
+            await self._idle.wait()
+            saves = self._saves
+            pending = self.pending(user_id)
+            result = await read()
+            if self._saves == saves:
+                return result, pending
+
+    async def flush(self):
+        """Сохраняет накопленные ответы. При временной ошибке ответы возвращаются в буфер."""
+        async with self.lock:
+            if not self._events:
+                return
+
+            events, self._events = self._events, []
+            self._saving, self._pending = self._pending, {}
+            self._saving_cards, self._cards = self._cards, {}
+            self._saves += 1
+            self._idle.clear()
+            try:
+                await self._save(events)
+            except self._permanent_errors:
+                logging.warning("Stats batch was rejected, saving answers per user", extra={"answers": len(events)})
+                self._requeue(await self._save_per_user(events))
+            except Exception:
+                self._requeue(events)
+                raise
+            finally:
+                self._saving = {}
+                self._saving_cards = {}
+                self._idle.set()
+
+    async def _save_per_user(self, events: list) -> list:
+        """Сохраняет ответы каждого пользователя отдельной транзакцией. Ответы, отклоненные постоянной ошибкой,
+        отбрасываются. Возвращает ответы, которые не удалось сохранить из-за временной ошибки."""
+        users = {}
+        for event in events:
+            users.setdefault(event[0], []).append(event)
+
+        failed = []
+        for user_id, user_events in users.items():
+            try:
+                await self._save(user_events)
+            except self._permanent_errors:
+                logging.exception("Dropped answers rejected by the database", extra={"user_id": user_id, "answers": len(user_events)})
+            except Exception:
+                failed.extend(user_events)
+        return failed
+
+    def _requeue(self, events: list):
+        """Возвращает ответы в начало буфера. Если буфер переполнен, самые старые ответы отбрасываются."""
+        buffered, self._events, self._pending, self._cards = self._events, [], {}, {}
+        events = events + buffered
+        dropped = len(events) - self._max_buffered
+        if dropped > 0:
+            logging.error("Stats buffer is full, oldest answers dropped", extra={"answers": dropped})
+            events = events[dropped:]
+        self._add_events(events)
+
+    def start(self):
+        """Запускает периодическое сохранение буфера."""
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает периодическое сохранение и сохраняет остаток буфера."""
+        if self._timer is not None:
+            self._timer.cancel()
+            try:
+                await self._timer
+            except asyncio.CancelledError:
+                pass
+            self._timer = None
+
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to flush user stats")
+
+    def _on_flush_done(self, task: asyncio.Task):
+        self._flush_task = None
+        if not task.cancelled() and task.exception():
+            logging.error("Failed to flush user stats", exc_info=task.exception())
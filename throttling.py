@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+from metrics import THROTTLED_UPDATES
+from rate_limiter import TokenBucket
+
+
+# Флаг обработчика с именем группы ограничения: @dp.message(..., flags={"throttling": "quiz"}).
+# Обработчики без флага не ограничиваются
+THROTTLING_FLAG = "throttling"
+
+# Флаг обработчика, для которого лишние обновления не отбрасываются, а объединяются:
+# обрабатывается только последнее обновление, когда у пользователя появится токен
+COALESCE_FLAG = "coalesce"
+
+THROTTLED_TEXT = "⏳ Слишком много запросов, подождите немного"
+
+
+def parse_limit(value: str) -> tuple:
+    """Разбирает ограничение группы из settings.ini: "rate, burst" - обновлений в секунду и запас."""
+    rate, burst = (float(part) for part in value.split(","))
+    return rate, burst
+
+
+class UserBucket(TokenBucket):
+    """Корзина токенов пользователя в группе обработчиков.
+    notified - пользователь уже получил предупреждение о превышении лимита,
+    latest - номер последнего обновления, которое ждет токен в режиме объединения."""
+
+    __slots__ = ("notified", "latest")
+
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.notified = False
+        self.latest = 0
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Middleware, которое ограничивает частоту обновлений от одного пользователя до вызова обработчика
+    (и запросов к БД в crud.py). Подключается к событиям message и callback_query.
+
+    Группа обработчика задается флагом throttling, у каждой группы свой лимит limits[group] = (rate, burst).
+    Лишние обновления отбрасываются; при первом отброшенном обновлении пользователь получает предупреждение
+    (одно на каждую серию), на остальные отброшенные нажатия кнопок отправляется пустой ответ. Для обработчиков с флагом coalesce обновление ждет токен, и обрабатывается
+    только последнее из ожидающих. Корзин хранится не больше max_buckets: при превышении удаляются
+    корзины, которые дольше всего не использовались."""
+
+    def __init__(self, limits: dict, max_buckets: int = 100_000):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._sequence = itertools.count(1)
+
+    def _bucket(self, user_id: int, group: str, rate: float, burst: float) -> UserBucket:
+        key = (user_id, group)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+
+        bucket = self._buckets[key] = UserBucket(rate, burst)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    async def __call__(
+            self,
+            handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: types.TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        group = get_flag(data, THROTTLING_FLAG)
+        user = data.get("event_from_user")
+        if group not in self.limits or user is None:
+            return await handler(event, data)
+
+        bucket = self._bucket(user.id, group, *self.limits[group])
+        delay = bucket.delay()
+
+        if delay > 0 and get_flag(data, COALESCE_FLAG):
+            sequence = bucket.latest = next(self._sequence)
+            await asyncio.sleep(delay)
+            # Пока обновление ждало, пришло более новое: обрабатывается только оно
+            if bucket.latest != sequence:
+                THROTTLED_UPDATES.labels(group=group, action="coalesced").inc()
+                if isinstance(event, types.CallbackQuery):
+                    await event.answer()
+                return None
+            delay = bucket.delay()
+
+        if delay > 0:
+            THROTTLED_UPDATES.labels(group=group, action="dropped").inc()
+            if not bucket.notified:
+                bucket.notified = True
+                await self._notify(event)
+            elif isinstance(event, types.CallbackQuery):
+                # Без ответа у пользователя остается индикатор загрузки на кнопке
+                await event.answer()
+            return None
+
+        bucket.reserve()
+        bucket.notified = False
+        return await handler(event, data)
+
+    @staticmethod
+    async def _notify(event: types.TelegramObject):
+        """Сообщает пользователю, что обновление не обработано. Запросов к БД не выполняет."""
+        if isinstance(event, (types.Message, types.CallbackQuery)):
+            await event.answer(THROTTLED_TEXT)
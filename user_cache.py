@@ -0,0 +1,36 @@
+from collections import OrderedDict
+
+
+class KnownUsers:
+    """Ограниченный LRU-кэш зарегистрированных пользователей.
+    Хранит для каждого user_id последние известные name и full_name.
+    При превышении max_size вытесняются пользователи, которые обращались к боту раньше всех."""
+
+    def __init__(self, max_size: int = 100_000):
+        self._max_size = max_size
+        self._users = OrderedDict()
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def get(self, user_id: int):
+        """Возвращает (name, full_name) пользователя или None, если его нет в кэше."""
+        user = self._users.get(user_id)
+        if user is not None:
+            self._users.move_to_end(user_id)
+        return user
+
+    def put(self, user_id: int, name: str, full_name: str):
+        """Добавляет пользователя в кэш или обновляет его данные."""
+        self._users[user_id] = (name, full_name)
+        self._users.move_to_end(user_id)
+
+        if len(self._users) > self._max_size:
+            self._users.popitem(last=False)
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook, который обрабатывает обновления в фоне и при остановке
+    дожидается завершения уже принятых обновлений, прежде чем закрыть сессию бота."""
+
+    def __init__(self, *args, shutdown_timeout: float = 10, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self.shutdown_timeout = shutdown_timeout
+
+    async def close(self) -> None:
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            logging.info("Waiting for updates before shutdown", extra={"updates": len(tasks)})
+            await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+        await super().close()
+
+
+def create_app(dp: Dispatcher, bot: Bot, path: str, secret_token: str = None) -> web.Application:
+    """Создает aiohttp-приложение, которое передает обновления из webhook в диспетчер."""
+    app = web.Application()
+    DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token or None).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def serve(
+        dp: Dispatcher,
+        bot: Bot,
+        host: str,
+        port: int,
+        path: str,
+        secret_token: str = None,
+        reuse_port: bool = False,
+        worker: int = 0
+):
+    """Запускает webhook-сервер в текущем процессе. Останавливается по SIGINT/SIGTERM.
+    Номер процесса worker передается обработчикам запуска диспетчера.
+    Процесс из нескольких (reuse_port) пишет журнал в свой файл."""
+    if reuse_port:
+        from logging_setup import use_worker_file
+        use_worker_file(worker)
+
+    dp["worker"] = worker
+    app = create_app(dp, bot, path, secret_token)
+    web.run_app(app, host=host, port=port, reuse_port=reuse_port, print=None)
+
+
+def run_webhook(dp: Dispatcher, bot: Bot, host: str, port: int, path: str, secret_token: str = None, workers: int = 1):
+    """Запускает webhook-сервер в workers процессах.
+    Процессы слушают один порт (SO_REUSEPORT), и входящие обновления распределяются между ними ядром.
+    SIGTERM передается всем процессам, и каждый из них завершается штатно.
+    SIGINT (Ctrl+C) процессы получают напрямую от терминала."""
+    if workers <= 1:
+        serve(dp, bot, host, port, path, secret_token)
+        return
+
+    processes = [
+        multiprocessing.Process(target=serve, args=(dp, bot, host, port, path, secret_token, True, worker))
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+
+    logging.info("Webhook server started", extra={"host": host, "port": port, "path": path, "workers": workers})
+
+    for process in processes:
+        process.join()